@@ -4,7 +4,8 @@
 
 # Usage: python3 -i ./interact.py
 
-import serial, time, re, struct, sys, random, socket, os
+import serial, time, re, struct, sys, random, socket, os, hashlib, mmap, zlib, statistics, json
+from collections import OrderedDict
 
 KiB = 1 << 10
 MiB = 1 << 20
@@ -31,6 +32,23 @@ def get_be16(data, offset):
 def get_be32(data, offset):
     return get_be16(data, offset) << 16 | get_be16(data, offset+2)
 
+# Internet checksum, as used in IPv4 headers
+def ip_checksum(data):
+    total = sum(struct.unpack('>%dH' % (len(data) // 2), data))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+# Turn a sorted list of integers into (start, end) ranges of consecutive ones
+def contiguous_runs(items):
+    runs = []
+    for x in items:
+        if runs and runs[-1][1] == x:
+            runs[-1] = (runs[-1][0], x + 1)
+        else:
+            runs.append((x, x + 1))
+    return runs
+
 def hexdump(data):
     if data:
         for offset in range(0, len(data), 16):
@@ -41,12 +59,102 @@ def hexdump(data):
             print(line)
 
 
+# A cache of memory pages, for regions that are declared as either
+# 'immutable' (writes through lolmon invalidate the affected pages) or
+# 'write-through' (writes update cached pages). Least recently used pages
+# are evicted when the cache grows beyond max_bytes.
+class PageCache:
+    PAGE_SIZE = 0x400
+
+    def __init__(self, max_bytes=16*MiB):
+        self.max_bytes = max_bytes
+        self.regions = []
+        self.pages = OrderedDict()
+        self.hits = self.misses = 0
+
+    def add_region(self, addr, length, mode='immutable'):
+        assert mode in ['immutable', 'write-through']
+        self.regions.append((addr, addr + length, mode))
+
+    # The mode of the region that contains the whole range, or None
+    def mode(self, addr, length):
+        for start, end, mode in self.regions:
+            if start <= addr and addr + length <= end:
+                return mode
+        return None
+
+    def page_range(self, addr, length):
+        first = addr & ~(self.PAGE_SIZE - 1)
+        return range(first, addr + length, self.PAGE_SIZE)
+
+    # Read through the cache; fetch(page) reads one page from the device
+    def read(self, addr, length, fetch):
+        data = b''
+        for page in self.page_range(addr, length):
+            if page in self.pages:
+                self.pages.move_to_end(page)
+                self.hits += 1
+            else:
+                self.pages[page] = fetch(page)
+                self.misses += 1
+                while len(self.pages) * self.PAGE_SIZE > self.max_bytes:
+                    self.pages.popitem(last=False)
+            data += self.pages[page]
+        offset = addr & (self.PAGE_SIZE - 1)
+        return data[offset:offset+length]
+
+    def invalidate(self, addr=0, length=1 << 32):
+        if length >= len(self.pages) * self.PAGE_SIZE:
+            for page in [p for p in self.pages if addr - self.PAGE_SIZE < p < addr + length]:
+                del self.pages[page]
+        else:
+            for page in self.page_range(addr, length):
+                self.pages.pop(page, None)
+
+    # Memory was written through lolmon
+    def write(self, addr, data):
+        for page in self.page_range(addr, len(data)):
+            if page not in self.pages:
+                continue
+            if self.mode(page, self.PAGE_SIZE) != 'write-through':
+                del self.pages[page]
+                continue
+            buf = bytearray(self.pages[page])
+            start = max(addr, page)
+            end = min(addr + len(data), page + self.PAGE_SIZE)
+            buf[start-page:end-page] = data[start-addr:end-addr]
+            self.pages[page] = bytes(buf)
+
+    # Code ran on the board, and may have changed anything that isn't immutable
+    def invalidate_writable(self):
+        for page in list(self.pages):
+            if self.mode(page, self.PAGE_SIZE) != 'immutable':
+                del self.pages[page]
+
+    def summary(self):
+        print('Page cache: %d pages (%d KiB), %d hits, %d misses' %
+              (len(self.pages), len(self.pages) * self.PAGE_SIZE // 1024, self.hits, self.misses))
+
+
 class Lolmon:
+    MAX_LINE = 127 # the line buffer is 128 bytes, including the NUL
+    MAX_ARGS = 16  # argv entries per command
+    DMA_THRESHOLD = 0x1000 # bytes
+    FIND_MAX = 256         # matches per find command
+    FIND_CHUNK = 0x1000    # bytes per read, when searching on the host
+    BAUDRATES = [ 3000000, 2000000, 1500000, 1000000, 921600, 750000,
+                  500000, 460800, 230400, 115200 ]
+
     def __init__(self, device):
         self.device = device
         self.s = serial.Serial(device, baudrate=115200)
         self.prompt = b'> '
         self.debug = False
+        self.commands = 0 # number of commands sent, for statistics
+        self.known_commands = {}
+        self.divisor = 13 # UART divisor set by the monitor at boot
+        self.dma = None   # GDMA to offload large copies and fills to
+        self.cache = PageCache()
 
     def connection_test(self):
         self.s.write(b'\n')
@@ -91,6 +199,7 @@ class Lolmon:
             pos += len(chunk)
 
     def run_command(self, cmd):
+        self.commands += 1
         try:
             if self.debug:
                 print(':> %s' % cmd)
@@ -110,20 +219,50 @@ class Lolmon:
             raise e
 
     def run_command_noreturn(self, cmd):
+        self.commands += 1
         if self.debug:
             print(':> %s' % cmd)
         self.enter_with_echo(cmd)
         self.s.write(b'\n')
         assert self.s.read(2) == b'\r\n'
 
+    # Run several commands with as few round-trips as possible, by putting
+    # them on one line, separated by semicolons. Returns the combined output.
+    def run_batch(self, cmds):
+        output = b''
+        line = ''
+        for cmd in cmds:
+            assert len(cmd) <= self.MAX_LINE
+            if line and len(line) + 1 + len(cmd) > self.MAX_LINE:
+                output += self.run_command(line)
+                line = ''
+            line = line + ';' + cmd if line else cmd
+        if line:
+            output += self.run_command(line)
+        return output
+
     def writeX(self, cmd, size, addr, value):
         #print('poke %s %08x %s' % (cmd, addr, value))
         if isinstance(value, bytes):
             value = [x for x in value]
+        values = value if isinstance(value, list) else [value]
+        self.cache.write(addr, struct.pack('<%d%s' % (len(values), 'BHI'[size // 2]),
+                                           *[v & ((1 << 8 * size) - 1) for v in values]))
         if isinstance(value, list):
-            for v in value:
-                self.writeX(cmd, size, addr, v)
-                addr += size
+            # Put as many values into one command as the monitor accepts
+            pos = 0
+            while pos < len(value):
+                line = "%s %08x" % (cmd, addr)
+                n = 0
+                while pos + n < len(value) and n < self.MAX_ARGS - 2:
+                    word = " %#x" % value[pos + n]
+                    if len(line) + len(word) > self.MAX_LINE:
+                        break
+                    line += word
+                    n += 1
+                self.run_command(line)
+                pos += n
+                addr += n * size
         else:
             self.run_command("%s %08x %#x" % (cmd, addr, value))
 
@@ -131,18 +270,39 @@ class Lolmon:
     def write16(self, addr, value): return self.writeX('wh', 2, addr, value)
     def write32(self, addr, value): return self.writeX('ww', 4, addr, value)
 
+    # Write a byte string, using 32-bit writes for the aligned middle part
+    def write_data(self, addr, data):
+        head = min(-addr & 3, len(data))
+        body = (len(data) - head) & ~3
+        if head:
+            self.write8(addr, data[:head])
+        if body:
+            self.write32(addr + head, list(struct.unpack('<%dI' % (body // 4), data[head:head+body])))
+        if head + body < len(data):
+            self.write8(addr + head + body, data[head+body:])
+
     def write_file(self, addr, filename):
         with open(filename, 'rb') as f:
             data = f.read()
             f.close()
-            self.write8(addr, data)
+            self.write_data(addr, data)
 
     def flash(self, memaddr, flashaddr, size):
+        self.cache.invalidate(FIU.MMFLASH_BASE | (flashaddr & 0xffffff), size)
         self.run_command("fl %08x %08x %#x" % (memaddr, flashaddr, size))
 
     def memset(self, addr, value, size):
         value16 = value << 8 | value
         value32 = value16 << 16 | value16
+        self.cache.invalidate(addr, size)
+        if self.dma and size >= self.DMA_THRESHOLD:
+            head = -addr & 3
+            body = (size - head) & ~3
+            self.memset(addr, value, head)
+            if self.dma.fill(addr + head, value32, body // 4):
+                head += body
+            addr += head
+            size -= head
         while size > 0:
             if addr & 3 != 0 or size < 4:
                 n = size & 3 or 1
@@ -166,17 +326,46 @@ class Lolmon:
 
 
     def readX(self, cmd, size, addr, num):
-        output = self.run_command("%s %08x %d" % (cmd, addr, num))
-        a = self.parse_r_output(output)
+        if self.cache.mode(addr, size * num):
+            data = self.cache.read(addr, size * num, self.read_page)
+            a = list(struct.unpack('<%d%s' % (num, 'BHI'[size // 2]), data))
+        else:
+            output = self.run_command("%s %08x %d" % (cmd, addr, num))
+            a = self.parse_r_output(output)
         if num == 1:  return a[0]
         elif size==1: return bytes(a)
         else:         return a
 
+    def read_page(self, addr):
+        words = self.parse_r_output(self.run_command('rw %08x %d' % (addr, PageCache.PAGE_SIZE // 4)))
+        return struct.pack('<%dI' % len(words), *words)
+
     def read8(self, addr, num=1):  return self.readX('rb', 1, addr, num)
     def read16(self, addr, num=1): return self.readX('rh', 2, addr, num)
     def read32(self, addr, num=1): return self.readX('rw', 4, addr, num)
 
+    # Read a byte string, using 32-bit reads for the aligned middle part,
+    # because their output takes fewer characters per byte
+    def read_data(self, addr, length):
+        head = min(-addr & 3, length)
+        body = (length - head) & ~3
+        data = b''
+        if head:
+            data += bytes(self.readX('rb', 1, addr, head) if head > 1 else [self.read8(addr)])
+        if body:
+            words = self.read32(addr + head, body // 4)
+            data += struct.pack('<%dI' % (body // 4), *(words if body > 4 else [words]))
+        tail = length - head - body
+        if tail:
+            data += bytes(self.readX('rb', 1, addr + head + body, tail) if tail > 1 else [self.read8(addr + head + body)])
+        return data
+
     def copyX(self, cmd, dest, src, num):
+        size = { 'cb': 1, 'ch': 2, 'cw': 4 }[cmd]
+        self.cache.invalidate(dest, num * size)
+        if self.dma and num * size >= self.DMA_THRESHOLD:
+            if self.dma.copy(dest, src, num, size):
+                return
         self.run_command("%s %08x %08x %d" % (cmd, src, dest, num))
 
     def copy8(self, dest, src, num):  self.copyX('cb', dest, src, num)
@@ -204,7 +393,141 @@ class Lolmon:
     dump16 = make_dump('rh')
     dump32 = make_dump('rw')
 
+    # Check whether the monitor has a command; newer versions have more
+    def has_command(self, name):
+        if name not in self.known_commands:
+            answer = self.run_command('help ' + name)
+            self.known_commands[name] = not answer.startswith(b'Unknown command')
+        return self.known_commands[name]
+
+    # Check that the link works, by echoing a random token. Unlike
+    # run_command, this gives up after a deadline, so that it doesn't hang
+    # when the baud rates don't match. The token comes back twice: as the
+    # echo of the command line, and as the output of echo.
+    def echo_test(self, deadline=0.5):
+        timeout = self.s.timeout
+        self.s.timeout = 0.05
+        try:
+            self.s.write(b'\n')
+            time.sleep(0.05)
+            self.s.reset_input_buffer()
+            token = b'lol%08x' % random.getrandbits(32)
+            self.s.write(b'echo ' + token + b'\n')
+            answer = b''
+            end = time.monotonic() + deadline
+            while time.monotonic() < end:
+                answer += self.s.read(256)
+                if answer.count(token) >= 2 and self.prompt in answer[answer.rfind(token):]:
+                    return True
+            return False
+        except serial.SerialException:
+            return False
+        finally:
+            self.s.timeout = timeout
+
+    @staticmethod
+    def baud_divisor(baudrate, uart_clock):
+        div = max(2, round(uart_clock / 16 / baudrate))
+        error = abs(uart_clock / 16 / div - baudrate) / baudrate
+        return div, error
+
+    # Switch both ends of the link to a new baud rate. The monitor's baud
+    # command waits for its transmitter to drain before it switches. If the
+    # link doesn't work afterwards, the old rate is restored; if the board
+    # did switch, this requires sending the restore command blindly.
+    def set_baudrate(self, baudrate, div):
+        old_rate, old_div = self.s.baudrate, self.divisor
+        try:
+            self.s.baudrate = baudrate
+        except (ValueError, serial.SerialException):
+            print('Baud rate %d is not supported on this host' % baudrate)
+            return False
+        finally:
+            self.s.baudrate = old_rate
+
+        self.run_command_noreturn('baud %d' % div)
+        time.sleep(0.05)
+        self.s.baudrate = baudrate
+        if self.echo_test():
+            self.divisor = div
+            return True
+
+        print('Baud rate %d does not work, falling back to %d' % (baudrate, old_rate))
+        self.s.baudrate = old_rate
+        if self.echo_test():
+            return False
+        self.s.baudrate = baudrate
+        self.s.write(b'\nbaud %d\n' % old_div)
+        self.s.flush()
+        time.sleep(0.05)
+        self.s.baudrate = old_rate
+        if not self.echo_test():
+            print('Lost the connection to lolmon!')
+        return False
+
+    # Go to the fastest baud rate that the UART clock allows with a divisor
+    # error of at most max_error, and that actually works. The UART clock
+    # comes from the clock tree by default; without one, it is derived from
+    # the current baud rate and divisor.
+    def escalate_baudrate(self, uart_clock=None, max_error=0.02):
+        if not self.has_command('baud'):
+            print('The monitor has no baud command')
+            return self.s.baudrate
+        derived = self.s.baudrate * 16 * self.divisor
+        if not uart_clock and 'clk' in globals():
+            uart_clock = clk.rate_uart()
+            if abs(uart_clock / derived - 1) > max_error:
+                print('UART clock is %.0f Hz according to the clock tree, but the '
+                      'current baud rate implies %.0f Hz' % (uart_clock, derived))
+        uart_clock = uart_clock or derived
+        for baudrate in self.BAUDRATES:
+            if baudrate <= self.s.baudrate:
+                break
+            div, error = self.baud_divisor(baudrate, uart_clock)
+            if error > max_error:
+                continue
+            if self.set_baudrate(baudrate, div):
+                print('Now at %d baud (divisor %d, %.1f%% off)' % (baudrate, div, error * 100))
+                break
+        return self.s.baudrate
+
+    # Find the addresses where pattern occurs in [start, end). With the
+    # monitor's find command, only the matches are sent over serial;
+    # otherwise, the range is read in overlapping chunks and searched here.
+    def find(self, pattern, start, end):
+        if isinstance(pattern, str):
+            pattern = pattern.encode('UTF-8')
+        matches = []
+        if self.has_command('find') and len(pattern) <= 32:
+            addr = start
+            while addr + len(pattern) <= end:
+                output = self.run_command('find %08x %d %s %d' %
+                                          (addr, end - addr, pattern.hex(), self.FIND_MAX))
+                found = [int(line, 16) for line in output.decode('UTF-8').splitlines()
+                         if re.fullmatch('[0-9a-f]{8}', line)]
+                matches += found
+                if len(found) < self.FIND_MAX:
+                    break
+                addr = found[-1] + 1
+        else:
+            for pos in range(start, end, self.FIND_CHUNK):
+                data = self.read_data(pos, min(self.FIND_CHUNK + len(pattern) - 1, end - pos))
+                i = data.find(pattern)
+                while 0 <= i < self.FIND_CHUNK:
+                    matches.append(pos + i)
+                    i = data.find(pattern, i + 1)
+        return matches
+
+    # CRC-32 of each block of memory, computed on the device (compatible with
+    # zlib.crc32), or None if the monitor can't do that
+    def crc32(self, addr, length, block=None):
+        if not self.has_command('crc'):
+            return None
+        output = self.run_command('crc %08x %d %d' % (addr, length, block or length))
+        return self.parse_r_output(output)
+
     def call(self, addr, a=0, b=0, c=0, d=0):
+        self.cache.invalidate_writable()
         self.run_command_noreturn('call %x %d %d %d %d' % (addr, a, b, c, d))
 
     def call_linux_and_run_microcom(self, addr):
@@ -219,9 +542,9 @@ class Block:
         if base:
             self.base = base
 
-    def read8(self, offset): return self.l.read8(self.base + offset)
-    def read16(self, offset): return self.l.read16(self.base + offset)
-    def read32(self, offset): return self.l.read32(self.base + offset)
+    def read8(self, offset, num=1): return self.l.read8(self.base + offset, num)
+    def read16(self, offset, num=1): return self.l.read16(self.base + offset, num)
+    def read32(self, offset, num=1): return self.l.read32(self.base + offset, num)
 
     def write8(self, offset, value): return self.l.write8(self.base + offset, value)
     def write16(self, offset, value): return self.l.write16(self.base + offset, value)
@@ -245,6 +568,8 @@ class Clocks(Block):
 
     CLKSEL_CPU_SHIFT    = 0
     CLKSEL_CPU_MASK     = 3
+    CLKSEL_CLKOUT_SHIFT = 2
+    CLKSEL_CLKOUT_MASK  = 3
     CLKSEL_USBPHY_SHIFT = 6
     CLKSEL_USBPHY_MASK  = 3
     CLKSEL_UART_SHIFT   = 8
@@ -275,90 +600,202 @@ class Clocks(Block):
     def clken(self, line, value):
         self.setclr32(self.CLKEN, line, value)
 
-    def rate_ref(self):
-        return 48000000
-
-    def pllcon_to_rate(self, pllcon):
-        if pllcon & self.PLLCON_PRST:
-            return 0
-        indv = (pllcon >> self.PLLCON_INDV_SHIFT) & self.PLLCON_INDV_MASK
-        otdv = (pllcon >> self.PLLCON_OTDV_SHIFT) & self.PLLCON_OTDV_MASK
-        fbdv = (pllcon >> self.PLLCON_FBDV_SHIFT) & self.PLLCON_FBDV_MASK
-        return int(self.rate_ref() / (indv+1) * (fbdv+1) / (otdv+1))
-
-    def rate_pll0(self): return self.pllcon_to_rate(self.read32(self.PLLCON0))
-    def rate_pll1(self): return self.pllcon_to_rate(self.read32(self.PLLCON1))
-
-    def rate_select(self, shift):
-        sources = [ self.rate_pll0, self.rate_pll1, self.rate_ref ]
-        return sources[(self.read32(self.CLKSEL) >> shift) & 3]()
-
-    def rate_cpu(self):    return self.rate_select(self.CLKSEL_CPU_SHIFT) // 2
-    def rate_clkout(self): return self.rate_select(self.CLKSEL_CLKOUT_SHIFT)
-    def rate_usbphy(self): return self.rate_select(self.CLKSEL_USBPHY_SHIFT)
-
-    def rate_uart(self):
-        div = (self.read32(self.CLKDIV) >> self.CLKDIV_UART_SHIFT) & self.CLKDIV_UART_MASK
-        return self.rate_select(self.CLKSEL_UART_SHIFT) // (div + 1)
-
-    def div(self, shift):
-        div = (self.read32(self.CLKDIV) >> shift) & 3
-        return [ 1, 2, 4, 8 ][div]
-
-    def rate_ahb(self):  return self.rate_cpu() // self.div(self.CLKDIV_AHB_SHIFT)
-    def rate_ahb3(self): return self.rate_ahb() // self.div(self.CLKDIV_AHB3_SHIFT)
-    def rate_apb(self):  return self.rate_ahb() // self.div(self.CLKDIV_APB_SHIFT)
-    def rate_adc(self):  return self.rate_ref() // self.div(self.CLKDIV_ADC_SHIFT)
+    # Read CLKEN through PLLCON1 with one command, and build a model from it
+    def tree(self):
+        return ClockTree(*self.read32(self.CLKEN, 5))
+
+    def rate_ref(self):    return self.tree().rate('ref')
+    def rate_pll0(self):   return self.tree().rate('pll0')
+    def rate_pll1(self):   return self.tree().rate('pll1')
+    def rate_cpu(self):    return self.tree().rate('cpu')
+    def rate_clkout(self): return self.tree().rate('clkout')
+    def rate_usbphy(self): return self.tree().rate('usbphy')
+    def rate_uart(self):   return self.tree().rate('uart')
+    def rate_ahb(self):    return self.tree().rate('ahb')
+    def rate_ahb3(self):   return self.tree().rate('ahb3')
+    def rate_apb(self):    return self.tree().rate('apb')
+    def rate_adc(self):    return self.tree().rate('adc')
 
     def set_div(self, shift, div):
-        table = { 2**n: n for n in range(4) }
-        x = self.read32(self.CLKDIV)
-        x &= ~(3 << shift)
-        x |= table[div] << shift
-        self.write32(self.CLKDIV, x)
+        self.apply(self.tree().with_div(shift, div))
 
     def set_sel(self, shift, parent):
-        table = { 'pll0': 0, 'pll1': 1, 'ref': 2 }
-        x = self.read32(self.CLKSEL)
-        x &= ~(3 << shift)
-        x |= table[parent] << shift
-        self.write32(self.CLKSEL, x)
+        self.apply(self.tree().with_sel(shift, parent))
+
+    # Write the registers that differ between the current state and tree.
+    # A new PLL1 setting is written first, and given time to lock before
+    # anything is switched to it; everything else goes out in one batch.
+    def apply(self, tree, old=None):
+        old = old or self.tree()
+        if tree.pllcon1 != old.pllcon1:
+            self.write32(self.PLLCON1, tree.pllcon1)
+            time.sleep(0.01)
+        cmds = []
+        for reg in [self.CLKSEL, self.CLKDIV]:
+            if tree.regs()[reg] != old.regs()[reg]:
+                cmds.append('ww %08x %#x' % (self.base + reg, tree.regs()[reg]))
+        self.l.run_batch(cmds)
 
     def summary(self):
-        print(f'Clock summary:')
-        print(f'  REF:      {self.rate_ref()   :10} Hz')
-        print(f'  PLL0:     {self.rate_pll0()  :10} Hz')
-        print(f'  PLL1:     {self.rate_pll1()  :10} Hz')
-        print(f'  CPU:      {self.rate_cpu()   :10} Hz')
-        print(f'  USBPHY:   {self.rate_usbphy():10} Hz')
-        print(f'  UART:     {self.rate_uart()  :10} Hz')
-        print(f'  AHB:      {self.rate_ahb()   :10} Hz')
-        print(f'  AHB3:     {self.rate_ahb3()  :10} Hz')
-        print(f'  APB:      {self.rate_apb()   :10} Hz')
-        print(f'  ADC:      {self.rate_adc()   :10} Hz')
+        self.tree().summary()
 
     def make_cpu_slow(self):
-        # Copy PLL0 configuration to PLL1, but divide by 2
-        pllcon0 = self.read32(self.PLLCON0)
-        self.write32(self.PLLCON1, pllcon0 | (1 << self.PLLCON_OTDV_SHIFT))
-        print(f"PLL0 at {self.rate_pll0()} Hz, PLL1 at {self.rate_pll1()} Hz")
-
-        # Switch CPU clock to PLL1
-        self.set_sel(self.CLKSEL_CPU_SHIFT, 'pll1')
-        print(f"AHB3 now at {self.rate_ahb3()}")
+        # Copy PLL0 configuration to PLL1, but divide by 2, and switch the
+        # CPU clock to PLL1
+        old = self.tree()
+        tree = old.with_pll1(old.pllcon0 | (1 << self.PLLCON_OTDV_SHIFT))
+        tree = tree.with_sel(self.CLKSEL_CPU_SHIFT, 'pll1')
+        print(f"PLL0 at {tree.rate('pll0')} Hz, PLL1 at {tree.rate('pll1')} Hz")
+        self.apply(tree, old)
+        print(f"AHB3 now at {tree.rate('ahb3')}")
 
     def make_ahb3_fast(self):
-        ahb = self.rate_ahb()
-        for div in [1, 2, 4, 8]:
-            if ahb / div <= 60_000000:
-                self.set_div(self.CLKDIV_AHB3_SHIFT, div)
-                break
-        print(f"AHB3 clock now at {self.rate_ahb3()} Hz")
+        old = self.tree()
+        tree = old.plan(ahb3_max=60_000000, cpu=False, uart=False)
+        self.apply(tree, old)
+        print(f"AHB3 clock now at {tree.rate('ahb3')} Hz")
 
     def make_cpu_24mhz(self):
-        self.set_div(self.CLKDIV_AHB_SHIFT, 1)
-        self.set_div(self.CLKDIV_APB_SHIFT, 1)
-        clk.set_sel(clk.CLKSEL_CPU_SHIFT, 'ref')
+        tree = self.tree()
+        tree = tree.with_div(self.CLKDIV_AHB_SHIFT, 1)
+        tree = tree.with_div(self.CLKDIV_APB_SHIFT, 1)
+        self.apply(tree.with_sel(self.CLKSEL_CPU_SHIFT, 'ref'))
+
+
+# A model of the clock tree, built from a snapshot of the clock registers.
+# Rates are computed once and memoized; the with_* methods return modified
+# copies, so that configurations can be evaluated without touching hardware.
+class ClockTree:
+    REF = 48000000
+    SOURCES = [ 'pll0', 'pll1', 'ref' ]
+    DIVS = [ 1, 2, 4, 8 ]
+
+    def __init__(self, clken, clksel, clkdiv, pllcon0, pllcon1):
+        self.clken = clken
+        self.clksel = clksel
+        self.clkdiv = clkdiv
+        self.pllcon0 = pllcon0
+        self.pllcon1 = pllcon1
+        self.rates = {}
+
+    def regs(self):
+        return { Clocks.CLKEN: self.clken, Clocks.CLKSEL: self.clksel,
+                 Clocks.CLKDIV: self.clkdiv, Clocks.PLLCON0: self.pllcon0,
+                 Clocks.PLLCON1: self.pllcon1 }
+
+    def copy(self, **changes):
+        regs = dict(clken=self.clken, clksel=self.clksel, clkdiv=self.clkdiv,
+                    pllcon0=self.pllcon0, pllcon1=self.pllcon1)
+        regs.update(changes)
+        return ClockTree(**regs)
+
+    def with_sel(self, shift, parent):
+        x = self.clksel & ~(3 << shift)
+        return self.copy(clksel=x | (self.SOURCES.index(parent) << shift))
+
+    def with_div(self, shift, div):
+        x = self.clkdiv & ~(3 << shift)
+        return self.copy(clkdiv=x | (self.DIVS.index(div) << shift))
+
+    def with_uart_div(self, div):
+        x = self.clkdiv & ~(Clocks.CLKDIV_UART_MASK << Clocks.CLKDIV_UART_SHIFT)
+        return self.copy(clkdiv=x | ((div - 1) << Clocks.CLKDIV_UART_SHIFT))
+
+    def with_pll1(self, pllcon):
+        return self.copy(pllcon1=pllcon)
+
+    def sel(self, shift):
+        return self.SOURCES[(self.clksel >> shift) & 3]
+
+    def div(self, shift):
+        return self.DIVS[(self.clkdiv >> shift) & 3]
+
+    @staticmethod
+    def pllcon_to_rate(pllcon):
+        if pllcon & Clocks.PLLCON_PRST:
+            return 0
+        indv = (pllcon >> Clocks.PLLCON_INDV_SHIFT) & Clocks.PLLCON_INDV_MASK
+        otdv = (pllcon >> Clocks.PLLCON_OTDV_SHIFT) & Clocks.PLLCON_OTDV_MASK
+        fbdv = (pllcon >> Clocks.PLLCON_FBDV_SHIFT) & Clocks.PLLCON_FBDV_MASK
+        return int(ClockTree.REF / (indv+1) * (fbdv+1) / (otdv+1))
+
+    def rate(self, name):
+        if name not in self.rates:
+            self.rates[name] = self.compute(name)
+        return self.rates[name]
+
+    def compute(self, name):
+        if name == 'ref':    return self.REF
+        if name == 'pll0':   return self.pllcon_to_rate(self.pllcon0)
+        if name == 'pll1':   return self.pllcon_to_rate(self.pllcon1)
+        if name == 'cpu':    return self.rate(self.sel(Clocks.CLKSEL_CPU_SHIFT)) // 2
+        if name == 'clkout': return self.rate(self.sel(Clocks.CLKSEL_CLKOUT_SHIFT))
+        if name == 'usbphy': return self.rate(self.sel(Clocks.CLKSEL_USBPHY_SHIFT))
+        if name == 'uart':
+            div = (self.clkdiv >> Clocks.CLKDIV_UART_SHIFT) & Clocks.CLKDIV_UART_MASK
+            return self.rate(self.sel(Clocks.CLKSEL_UART_SHIFT)) // (div + 1)
+        if name == 'ahb':    return self.rate('cpu') // self.div(Clocks.CLKDIV_AHB_SHIFT)
+        if name == 'ahb3':   return self.rate('ahb') // self.div(Clocks.CLKDIV_AHB3_SHIFT)
+        if name == 'apb':    return self.rate('ahb') // self.div(Clocks.CLKDIV_APB_SHIFT)
+        if name == 'adc':    return self.rate('ref') // self.div(Clocks.CLKDIV_ADC_SHIFT)
+        raise KeyError(name)
+
+    # PLL1 settings worth trying: the current one, and, if nothing runs from
+    # PLL1 yet, PLL0's setting with each output divider
+    def pll1_candidates(self):
+        yield self.pllcon1
+        users = [Clocks.CLKSEL_CPU_SHIFT, Clocks.CLKSEL_CLKOUT_SHIFT,
+                 Clocks.CLKSEL_USBPHY_SHIFT, Clocks.CLKSEL_UART_SHIFT]
+        if any(self.sel(shift) == 'pll1' for shift in users):
+            return
+        base = self.pllcon0 & ~(Clocks.PLLCON_OTDV_MASK << Clocks.PLLCON_OTDV_SHIFT)
+        for otdv in range(Clocks.PLLCON_OTDV_MASK + 1):
+            pllcon = base | (otdv << Clocks.PLLCON_OTDV_SHIFT)
+            if pllcon != self.pllcon1:
+                yield pllcon
+
+    # Search for the configuration with the fastest AHB3 clock at or below
+    # ahb3_max, and then the fastest UART clock at or below uart_max. The
+    # CPU and AHB clocks never get faster than they are now. With cpu=False,
+    # only the AHB3 divider is changed; with uart=False, the UART clock is
+    # left alone. Nothing is written; pass the result to Clocks.apply. Note
+    # that a new UART clock also changes the console's baud rate.
+    def plan(self, ahb3_max=60_000000, uart_max=None, cpu=True, uart=True):
+        uart_max = uart_max or self.REF
+        best, best_score = self, None
+        for pllcon1 in self.pll1_candidates() if cpu else [self.pllcon1]:
+            base = self.with_pll1(pllcon1)
+            for source in self.SOURCES if cpu else [self.sel(Clocks.CLKSEL_CPU_SHIFT)]:
+                tree = base.with_sel(Clocks.CLKSEL_CPU_SHIFT, source)
+                if tree.rate('ahb') > self.rate('ahb'):
+                    continue
+                for div in self.DIVS:
+                    t = tree.with_div(Clocks.CLKDIV_AHB3_SHIFT, div)
+                    if t.rate('ahb3') > ahb3_max:
+                        continue
+                    score = (t.rate('ahb3'), t.rate('cpu'), pllcon1 == self.pllcon1)
+                    if best_score is None or score > best_score:
+                        best, best_score = t, score
+                    break
+        if not uart:
+            return best
+        uart_best, uart_score = best, None
+        if best.rate('uart') <= uart_max:
+            uart_score = best.rate('uart')
+        for source in self.SOURCES:
+            tree = best.with_sel(Clocks.CLKSEL_UART_SHIFT, source)
+            for div in range(1, Clocks.CLKDIV_UART_MASK + 2):
+                t = tree.with_uart_div(div)
+                if t.rate('uart') <= uart_max:
+                    if uart_score is None or t.rate('uart') > uart_score:
+                        uart_best, uart_score = t, t.rate('uart')
+                    break
+        return uart_best
+
+    def summary(self):
+        print(f'Clock summary:')
+        for name in ['ref', 'pll0', 'pll1', 'cpu', 'usbphy', 'uart', 'ahb', 'ahb3', 'apb', 'adc']:
+            print(f'  {name.upper() + ":":9} {self.rate(name):10} Hz')
 
 
 class SHM(Block):
@@ -468,7 +905,8 @@ class EMC(Block):
     MCMDR_DEFAULT = MCMDR_OPMOD | MCMDR_EnMDC | MCMDR_FDUP | MCMDR_SPCRC
     MCMDR_ACTIVE = MCMDR_DEFAULT | MCMDR_TXON | MCMDR_RXON
 
-    ARP_BASE = 0xf0000   # start address of ARP frame
+    ARP_BASE = 0xf0000   # start address of ARP frames
+    ARP_SIZE = 0x1000    # memory for the ARP frame of each EMC
     BUFS_BASE = 0x100000 # start address of buffers
     BUF_SIZE = 0x800     # enough for 1 packet and descriptor
     FRAME_SIZE = 0x600   # max. bytes per frame
@@ -558,6 +996,9 @@ class EMC(Block):
 
         CONTROL_GO = CONTROL_OWNER_EMC | CONTROL_CRCAPP | CONTROL_PADEN
 
+        # Whether the buffer still holds the headers from EMC.pull_setup
+        has_pull_header = False
+
         class Status:
             CONTROL_OWNER_EMC = BIT(31)
 
@@ -598,15 +1039,23 @@ class EMC(Block):
 
         def set_data(self, data):
             self.len = len(data)
+            self.has_pull_header = False
             self.l.write8(self.data_base, list(data))
 
         def set_data_by_copy(self, addr, length):
             self.len = length
+            self.has_pull_header = False
             self.l.copy8(self.data_base, addr, length)
 
         def set_data_dma(self, addr, length):
             self.l.write32(self.base + self.BUF_ADDR, addr)
             self.len = length
+            self.has_pull_header = False
+
+        def set_pull_header(self, header):
+            self.l.write32(self.base + self.BUF_ADDR, self.data_base)
+            self.l.write_data(self.data_base, header)
+            self.has_pull_header = True
 
         def dump_data(self):
             self.l.dump8(self.data_base, self.len)
@@ -665,12 +1114,14 @@ class EMC(Block):
         self.write32(self.DMARFC, self.FRAME_SIZE)
         self.write32(self.MCMDR, self.MCMDR_ACTIVE)
 
-        self.make_arp_packet(self.ARP_BASE)
+        # each EMC answers ARP with its own frame
+        index = (self.base - emc0.base) // (emc1.base - emc0.base)
+        self.make_arp_packet(self.ARP_BASE + self.ARP_SIZE * index)
 
     def fast_reset(self):
         # Rearm descriptors that were missed
         ctxdsa = self.read32(self.CTXDSA)
-        real_tx_head = [i for i, tx in enumerate(emc0.tx_bufs) if tx.base == ctxdsa][0]
+        real_tx_head = [i for i, tx in enumerate(self.tx_bufs) if tx.base == ctxdsa][0]
         head = real_tx_head
         while head != self.tx_head:
             self.tx_bufs[head].write_initial()
@@ -709,6 +1160,12 @@ class EMC(Block):
         self.l.write8(addr, b)
         self.arp_packet = addr
         self.arp_packet_len = len(b)
+        self.arp_packet_data = b
+
+    # Whether the ARP frame in memory is still the one make_arp_packet wrote
+    def check_arp_packet(self):
+        self.l.cache.invalidate(self.arp_packet, self.arp_packet_len)
+        return self.l.read_data(self.arp_packet, self.arp_packet_len) == self.arp_packet_data
 
     def stop(self):
         # initiate software reset
@@ -793,7 +1250,7 @@ class EMC(Block):
 
         # Determine new TX head
         ctxdsa = self.read32(self.CTXDSA)
-        real_tx_head = [i for i, tx in enumerate(emc0.tx_bufs) if tx.base == ctxdsa][0]
+        real_tx_head = [i for i, tx in enumerate(self.tx_bufs) if tx.base == ctxdsa][0]
 
         if self.read32(self.MISTA) & self.MISTA_TXBERR:
             # TX DMA error.  In this case, there are descriptors that were
@@ -876,39 +1333,58 @@ class EMC(Block):
                 self.handle_arp(buf)
             buf.rearm()
 
+    # Look at a received frame: Return its ethertype, and the chunk tag if it
+    # is a UDP packet to our IP and port 450 (otherwise None). ARP requests
+    # are answered on the way.
+    def classify_rx_buf(self, buf):
+        header = self.l.read8(buf.data_base, 0x30)
+        ethertype = get_be16(header, 0xc)
+        tag = None
+        if ethertype == self.ETHERTYPE_ARP:
+            self.handle_arp(buf)
+        if ethertype == self.ETHERTYPE_IP:
+            ip = get_be32(header, 0x1e)
+            port = get_be16(header, 0x24)
+            if ip == self.ip.to_int() and port == 450:
+                tag = header[0x2a:0x2e]
+        return ethertype, tag
+
     def push_data(self, addr, data):
+        self.l.cache.invalidate(addr, len(data))
         magic = random.getrandbits(16)
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         s.connect((str(self.ip), 450))
-        for i, n, chunk in self.data_chunks(data):
+        chunks = list(self.data_chunks(data))
+        tm = Telemetry([self], len(chunks))
+        for i, n, chunk in chunks:
             packet_done = False
             good_tag = struct.pack('>HH', magic, i)
-            print(f'\rpacket {i + 1}/{n}...', end='')
             s.send(good_tag + chunk)
             while not packet_done:
                 buf = self.try_get_rx_buf()
                 if not buf:
                     # retransmit only when necessary
                     s.send(good_tag + chunk)
+                    tm.count('retransmits')
                     continue
                 if not buf.status.is_good():
+                    tm.count('bad frames')
                     buf.rearm()
                     continue
 
-                header = self.l.read8(buf.data_base, 0x30)
-                ethertype = get_be16(header, 0xc)
+                ethertype, tag = self.classify_rx_buf(buf)
                 if ethertype == self.ETHERTYPE_ARP:
-                    self.handle_arp(buf)
-                if ethertype == self.ETHERTYPE_IP:
-                    ip = get_be32(header, 0x1e)
-                    port = get_be16(header, 0x24)
-                    tag = header[0x2a:0x2e]
-                    if ip == self.ip.to_int() and port == 450 and tag == good_tag:
-                        self.l.copy8(addr, buf.data_base + 0x2e, len(chunk))
-                        addr += len(chunk)
-                        packet_done = True
+                    tm.count('arp')
+                if tag == good_tag:
+                    self.l.copy8(addr, buf.data_base + 0x2e, len(chunk))
+                    addr += len(chunk)
+                    packet_done = True
+                    tm.packet_done(len(chunk))
+                elif tag and tag[:2] == good_tag[:2]:
+                    tm.count('duplicates')
                 buf.rearm()
-        print(' done')
+                tm.tick()
+        tm.summary()
 
     def push_file(self, addr, filename):
         with open(filename, 'rb') as f:
@@ -917,11 +1393,86 @@ class EMC(Block):
             print("Size: %#x bytes" % len(data))
             self.push_data(addr, data)
 
+    # Sending memory contents to the host: Each UDP packet carries a 4-byte
+    # offset tag and a chunk of data, behind prebuilt headers.
+    PULL_HEADER = 14 + 20 + 8 + 4
+    PULL_CHUNK = MTU - 20 - 8 - 4
+
+    # Learn the host's MAC and UDP port from a datagram it sends us, and put
+    # Ethernet, IP and UDP headers into all TX buffers. Other transmissions
+    # overwrite them, so pull_data puts them back where needed. Returns False
+    # if nothing arrives from the host.
+    def pull_setup(self, timeout=2):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.connect((str(self.ip), 450))
+        s.settimeout(0.2)
+        host_ip, host_port = s.getsockname()
+
+        hello = struct.pack('>HH', random.getrandbits(16), 0xffff)
+        host_mac = None
+        deadline = time.monotonic() + timeout
+        while not host_mac:
+            if time.monotonic() > deadline:
+                print('EMC.pull_setup: Nothing received from the host')
+                s.close()
+                return False
+            s.send(hello)
+            buf = self.try_get_rx_buf()
+            if not buf:
+                continue
+            if buf.status.is_good() and self.classify_rx_buf(buf)[1] == hello:
+                host_mac = self.l.read8(buf.data_base + 6, 6)
+            buf.rearm()
+
+        length = 20 + 8 + 4 + self.PULL_CHUNK
+        ip = struct.pack('>BBHHHBBH4s4s', 0x45, 0, length, 0, 0x4000, 64, 17, 0,
+                         self.ip.to_bytes(), socket.inet_aton(host_ip))
+        ip = ip[:10] + struct.pack('>H', ip_checksum(ip)) + ip[12:]
+        udp = struct.pack('>HHHH', 450, host_port, length - 20, 0)
+        self.pull_header = host_mac + self.mac.to_bytes() + struct.pack('>H', self.ETHERTYPE_IP) + ip + udp
+
+        for buf in self.tx_bufs:
+            buf.set_pull_header(self.pull_header)
+        self.pull_socket = s
+        return True
+
+    # Read memory by sending it to the host over Ethernet, which is much
+    # quicker than reading it in hex over serial. Lost packets are resent.
+    def pull_data(self, addr, length, retries=5):
+        if not getattr(self, 'pull_socket', None) and not self.pull_setup():
+            return None
+        self.setclr32(self.MCMDR, 21, 0) # no loopback, see dma_read
+
+        data = bytearray(length)
+        for offset in range(0, length, self.PULL_CHUNK):
+            n = min(self.PULL_CHUNK, length - offset)
+            for attempt in range(retries):
+                buf = self.get_tx_buf()
+                if not buf.has_pull_header:
+                    buf.set_pull_header(self.pull_header)
+                self.l.write8(buf.data_base + self.PULL_HEADER - 4, list(struct.pack('>I', offset)))
+                self.l.copy8(buf.data_base + self.PULL_HEADER, addr + offset, n)
+                buf.len = self.PULL_HEADER + self.PULL_CHUNK
+                self.submit_tx_buf(buf)
+                try:
+                    # skip late duplicates of earlier chunks
+                    packet = self.pull_socket.recv(2048)
+                    while struct.unpack('>I', packet[:4])[0] != offset:
+                        packet = self.pull_socket.recv(2048)
+                except socket.timeout:
+                    continue
+                data[offset:offset+n] = packet[4:4+n]
+                break
+            else:
+                print(f'EMC.pull_data: No packet for offset {offset:#x}')
+                return None
+        return bytes(data)
+
     def get_mdccr(self):
         return (self.read32(self.MIIDA) >> 20) & 0xf
 
     def set_mdccr(self, value):
-        miida = self.read32(emc0.MIIDA) & ~(0xf << 20)
+        miida = self.read32(self.MIIDA) & ~(0xf << 20)
         self.write32(self.MIIDA, miida | (value << 20))
 
     def mdio_do(self, phy, reg, write):
@@ -953,6 +1504,183 @@ class EMC(Block):
                 print('MDIO @ %d, device %04x:%04x' % (phy, hi, lo))
 
 
+# Transfer statistics: EMC hardware counters and error bits, sampled together
+# with host-side event counts and the number of lolmon commands per packet.
+class Telemetry:
+    HW_COUNTERS = ['MPCNT', 'MRPC', 'MRPCC', 'MREPC']
+    MISTA_ERRORS = ['RDU', 'RXBERR', 'TXABT', 'TXBERR']
+    EVENTS = ['retransmits', 'duplicates', 'arp', 'bad frames']
+
+    def __init__(self, emcs, packets=None, interval=0.5):
+        self.emcs = emcs
+        self.l = emcs[0].l
+        self.total_packets = packets
+        self.interval = interval
+        self.events = { name: 0 for name in self.EVENTS }
+        self.packets = 0
+        self.bytes = 0
+        self.own_commands = 0 # commands spent on sampling the hardware
+        self.errors = { emc: { name: 0 for name in self.MISTA_ERRORS } for emc in emcs }
+        self.hw_start = { emc: self.sample(emc) for emc in emcs }
+        self.hw_now = dict(self.hw_start)
+        self.commands_start = self.l.commands
+        self.start = self.last_report = time.monotonic()
+
+    # Read MISTA and the counters (MISTA...MREPC are consecutive) in one
+    # command, and acknowledge the error bits we've seen.
+    def sample(self, emc):
+        commands = self.l.commands
+        mista, mgsta, *counters = emc.read32(emc.MISTA, 6)
+        mask = 0
+        for name in self.MISTA_ERRORS:
+            bit = getattr(emc, 'MISTA_' + name)
+            if mista & bit:
+                self.errors[emc][name] += 1
+                mask |= bit
+        if mask:
+            emc.write32(emc.MISTA, mask)
+        self.own_commands += self.l.commands - commands
+        return dict(zip(self.HW_COUNTERS, counters))
+
+    def count(self, event, n=1):
+        self.events[event] += n
+
+    def packet_done(self, length):
+        self.packets += 1
+        self.bytes += length
+
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+    def rate(self):
+        return self.bytes / max(self.elapsed(), 1e-6)
+
+    def commands_per_packet(self):
+        commands = self.l.commands - self.commands_start - self.own_commands
+        return commands / max(self.packets, 1)
+
+    def hw_delta(self, emc):
+        return { name: (self.hw_now[emc][name] - self.hw_start[emc][name]) & 0xffffffff
+                 for name in self.HW_COUNTERS }
+
+    def status_line(self):
+        total = f'/{self.total_packets}' if self.total_packets else ''
+        line = f'packet {self.packets}{total}, {self.rate():.0f} B/s, '
+        line += f'{self.commands_per_packet():.1f} cmds/packet'
+        for event, n in self.events.items():
+            if n:
+                line += f', {event} {n}'
+        for emc in self.emcs:
+            errors = [f'{name} {n}' for name, n in self.errors[emc].items() if n]
+            if errors:
+                line += f', {emc.base:08x}: ' + ' '.join(errors)
+        return line
+
+    # Print a live status line, at most once per interval
+    def tick(self):
+        now = time.monotonic()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            for emc in self.emcs:
+                self.hw_now[emc] = self.sample(emc)
+            print('\r' + self.status_line() + '  ', end='')
+
+    def summary(self):
+        for emc in self.emcs:
+            self.hw_now[emc] = self.sample(emc)
+        print('\r' + self.status_line() + '  ')
+        print(f'Transferred {self.bytes} bytes in {self.packets} packets, {self.elapsed():.2f} s')
+        for emc in self.emcs:
+            hw = ', '.join(f'{name} {n}' for name, n in self.hw_delta(emc).items())
+            errors = ', '.join(f'{name} {n}' for name, n in self.errors[emc].items())
+            print(f'  EMC @ {emc.base:08x}: {hw}; {errors}')
+
+
+# One EMC's share of a striped upload
+class StripeLane:
+    def __init__(self, emc, chunks):
+        self.emc = emc
+        self.chunks = chunks # (index, total, data), in this lane's order
+        self.seq = 0         # position in this lane's chunk sequence
+        self.magic = random.getrandbits(16)
+        self.s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.s.connect((str(emc.ip), 450))
+
+    def is_done(self):
+        return self.seq == len(self.chunks)
+
+    def chunk(self):
+        return self.chunks[self.seq]
+
+    def tag(self):
+        return struct.pack('>HH', self.magic, self.seq)
+
+    def send(self):
+        self.s.send(self.tag() + self.chunk()[2])
+
+# Upload data through several EMCs at once. The chunks are dealt out
+# round-robin, and each EMC gets its own UDP socket, tag magic and chunk
+# sequence. The host must be able to reach each EMC's IP through the port that
+# it's cabled to.
+def push_data_striped(addr, data, emcs=None):
+    if not emcs:
+        emcs = [emc0, emc1]
+    emcs[0].l.cache.invalidate(addr, len(data))
+    for emc in emcs:
+        if not hasattr(emc, 'rx_bufs'):
+            emc.init()
+    for emc in emcs:
+        assert emc.check_arp_packet(), f'EMC @ {emc.base:08x}: ARP frame was overwritten'
+
+    chunks = list(emcs[0].data_chunks(data))
+    chunk_size = len(chunks[0][2]) if chunks else 0
+
+    lanes = [StripeLane(emc, chunks[k::len(emcs)]) for k, emc in enumerate(emcs)]
+    tm = Telemetry(emcs, len(chunks))
+    active = [lane for lane in lanes if not lane.is_done()]
+    for lane in active:
+        lane.send()
+
+    while active:
+        for lane in list(active):
+            emc = lane.emc
+            buf = emc.try_get_rx_buf()
+            if not buf:
+                # retransmit only when necessary
+                lane.send()
+                tm.count('retransmits')
+                continue
+            if not buf.status.is_good():
+                tm.count('bad frames')
+                buf.rearm()
+                continue
+
+            ethertype, tag = emc.classify_rx_buf(buf)
+            if ethertype == emc.ETHERTYPE_ARP:
+                tm.count('arp')
+            if tag == lane.tag():
+                i, n, chunk = lane.chunk()
+                emc.l.copy8(addr + i * chunk_size, buf.data_base + 0x2e, len(chunk))
+                tm.packet_done(len(chunk))
+                lane.seq += 1
+                if lane.is_done():
+                    active.remove(lane)
+                else:
+                    lane.send()
+            elif tag and tag[:2] == lane.tag()[:2]:
+                tm.count('duplicates')
+            buf.rearm()
+        tm.tick()
+    tm.summary()
+
+def push_file_striped(addr, filename, emcs=None):
+    with open(filename, 'rb') as f:
+        data = f.read()
+        f.close()
+        print("Size: %#x bytes" % len(data))
+        push_data_striped(addr, data, emcs)
+
+
 class GCR(Block):
     PDID = 0
     PWRON = 4
@@ -960,6 +1688,233 @@ class GCR(Block):
     MFSEL2 = 0x10
 
 
+# A host-side copy of the SPI flash contents, so that flash updates can be
+# planned without reading the flash back every time. A sector is known once it
+# has been completely read or written through FIU, and then has a hash.
+class FlashImage:
+    SECTOR_SIZE = 0x1000
+
+    def __init__(self, size=16*MiB):
+        self.size = size
+        self.data = bytearray(b'\xff' * size)
+        self.known = bytearray(size // self.SECTOR_SIZE)
+        self.hashes = [None] * (size // self.SECTOR_SIZE)
+
+    def sectors(self, addr, length):
+        return range(addr // self.SECTOR_SIZE, (addr + length + self.SECTOR_SIZE - 1) // self.SECTOR_SIZE)
+
+    def sector_hash(self, data):
+        return hashlib.sha256(data).digest()
+
+    # Whether the sector at addr is known to contain data, possibly only by
+    # its hash
+    def matches(self, addr, data):
+        i = addr // self.SECTOR_SIZE
+        return len(data) == self.SECTOR_SIZE and self.hashes[i] == self.sector_hash(data)
+
+    def rehash(self, i):
+        if self.known[i]:
+            self.hashes[i] = self.sector_hash(self.data[i * self.SECTOR_SIZE:(i + 1) * self.SECTOR_SIZE])
+        else:
+            self.hashes[i] = None
+
+    # Record what's in the flash now. Partially covered sectors only stay
+    # known if they were known before.
+    def update(self, addr, data):
+        self.data[addr:addr+len(data)] = data
+        for i in self.sectors(addr, len(data)):
+            if addr <= i * self.SECTOR_SIZE and (i + 1) * self.SECTOR_SIZE <= addr + len(data):
+                self.known[i] = 1
+            self.rehash(i)
+
+    def erase(self, addr, length):
+        self.update(addr, b'\xff' * length)
+
+    # Programming can only clear bits
+    def program(self, addr, data):
+        known = [self.known[i] for i in self.sectors(addr, len(data))]
+        old = self.data[addr:addr+len(data)]
+        self.update(addr, bytes(a & b for a, b in zip(old, data)))
+        for i, k in zip(self.sectors(addr, len(data)), known):
+            self.known[i] = k
+            self.rehash(i)
+
+    def invalidate(self, addr=0, length=None):
+        for i in self.sectors(addr, self.size if length is None else length):
+            self.known[i] = 0
+            self.hashes[i] = None
+
+    def read(self, addr, length):
+        return bytes(self.data[addr:addr+length])
+
+    # Keep the image across sessions. Only do this if nothing else writes
+    # the flash in the meantime.
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(self.data)
+        with open(filename + '.known', 'wb') as f:
+            f.write(self.known)
+
+    def load(self, filename):
+        with open(filename, 'rb') as f:
+            self.data[:] = f.read()
+        with open(filename + '.known', 'rb') as f:
+            self.known[:] = f.read()
+        for i in range(len(self.known)):
+            self.rehash(i)
+
+    # Take the sector hashes of an image that was flashed earlier from the
+    # manifest written by tools/compose-flash.py. Sectors that match it don't
+    # need to be read back before flashing. Only do this if nothing else
+    # wrote the flash since.
+    def load_manifest(self, filename):
+        with open(filename) as f:
+            manifest = json.load(f)
+        if manifest['sector_size'] != self.SECTOR_SIZE or manifest['hash'] != 'sha256':
+            print('Manifest does not match the flash image format')
+            return
+        count = 0
+        for i, h in enumerate(manifest['sectors'][:len(self.hashes)]):
+            if not self.known[i]:
+                self.hashes[i] = bytes.fromhex(h)
+                count += 1
+        print(f'{count} sector hashes taken from {filename}')
+
+
+# An SPI flash chip's geometry and typical erase times
+class SPIFlashChip:
+    def __init__(self, name, size, erase_times, chip_erase_time=None):
+        self.name = name
+        self.size = size
+        self.erase_times = erase_times # { block size: seconds }, for the supported sizes
+        self.chip_erase_time = chip_erase_time
+
+    def __repr__(self):
+        return '%s(%s, %d MiB)' % (self.__class__.__name__, self.name, self.size // MiB)
+
+    def block_sizes(self):
+        return sorted(self.erase_times)
+
+    # learn() changes the chip, so each FIU gets its own copy
+    def copy(self):
+        return SPIFlashChip(self.name, self.size, dict(self.erase_times), self.chip_erase_time)
+
+    # Blend a measured erase time into the expectation
+    def learn(self, size, seconds):
+        if size == self.size and self.chip_erase_time:
+            self.chip_erase_time = (self.chip_erase_time + seconds) / 2
+        elif size in self.erase_times:
+            self.erase_times[size] = (self.erase_times[size] + seconds) / 2
+
+
+# What it takes to turn the current flash contents at addr into data: Every
+# sector is skipped, programmed, or erased and programmed. Erases of aligned
+# runs of sectors can be coalesced into block or chip erases.
+class FlashPlan:
+    SECTOR_SIZE = 0x1000
+    PROGRAM_RATE = 50000 # bytes/s programmed by fl on the device
+    UPLOAD_RATE = 3000   # bytes/s staged through serial writes
+
+    def __init__(self, addr, data, old, image, chip):
+        self.addr = addr
+        self.data = data
+        self.chip = chip
+        self.erases = []    # (flash address, size) of erases done before programming
+        self.ops = [] # (offset, op)
+        for p in range(0, len(data), self.SECTOR_SIZE):
+            new = data[p:p+self.SECTOR_SIZE]
+            if image.matches(addr + p, new):
+                op = 'skip'
+            else:
+                op = FIU.sector_op(old[p:p+self.SECTOR_SIZE], new)
+            self.ops.append((p, op))
+        self.coalesce_erases()
+
+    # Use a larger erase wherever an aligned block consists only of sectors
+    # that are completely rewritten, and erasing it is expected to be quicker
+    # than erasing the sectors that need it one by one. A sector that data
+    # covers only partly is never part of a block erase, so nothing outside
+    # of data is lost. The remaining 4 KiB erases are left to fl.
+    def coalesce_erases(self):
+        S = self.SECTOR_SIZE
+        dirty = { (self.addr + offset) // S for offset, op in self.ops
+                  if op != 'skip' and offset + S <= len(self.data) }
+        need = { (self.addr + offset) // S for offset, op in self.ops if op == 'erase' }
+        t4k = self.chip.erase_times[S]
+        self.erases = []
+        if not need:
+            return
+
+        if (self.chip.chip_erase_time and len(dirty) == self.chip.size // S and
+                self.chip.chip_erase_time < len(need) * t4k):
+            self.erases.append((0, self.chip.size))
+            return
+
+        covered = set()
+        for size in reversed(self.chip.block_sizes()):
+            if size == S:
+                continue
+            n = size // S
+            first = min(need) // n * n
+            for block in range(first, max(need) + 1, n):
+                sectors = set(range(block, block + n))
+                if not sectors <= dirty or sectors & covered:
+                    continue
+                if self.chip.erase_times[size] < len(sectors & need) * t4k:
+                    self.erases.append((block * S, size))
+                    covered |= sectors
+        self.erases.sort()
+
+    def erased_sectors(self):
+        return { addr // self.SECTOR_SIZE + i for addr, size in self.erases
+                 for i in range(size // self.SECTOR_SIZE) }
+
+    def count(self, op):
+        return sum(1 for offset, o in self.ops if o == op)
+
+    # (offset, length) of runs of sectors that need to be written
+    def runs(self, max_length):
+        runs = []
+        for offset, op in self.ops:
+            length = min(self.SECTOR_SIZE, len(self.data) - offset)
+            if op == 'skip':
+                continue
+            if runs and sum(runs[-1]) == offset and runs[-1][1] + length <= max_length:
+                runs[-1] = (runs[-1][0], runs[-1][1] + length)
+            else:
+                runs.append((offset, length))
+        return runs
+
+    def erase_time(self):
+        t = 0
+        for addr, size in self.erases:
+            if size == self.chip.size and self.chip.chip_erase_time:
+                t += self.chip.chip_erase_time
+            else:
+                t += self.chip.erase_times[size]
+        erased = self.erased_sectors()
+        remaining = [offset for offset, op in self.ops if op == 'erase' and
+                     (self.addr + offset) // self.SECTOR_SIZE not in erased]
+        return t + len(remaining) * self.chip.erase_times[self.SECTOR_SIZE]
+
+    def estimate(self, upload_rate=None):
+        written = sum(length for offset, length in self.runs(len(self.data)))
+        return (written / (upload_rate or self.UPLOAD_RATE) +
+                written / self.PROGRAM_RATE +
+                self.erase_time())
+
+    def summary(self, upload_rate=None):
+        print(f"Flash plan for {self.addr:06x}-{self.addr + len(self.data):06x} on {self.chip.name}: "
+              f"{self.count('skip')} sectors to skip, {self.count('program')} to program, "
+              f"{self.count('erase')} to erase and program")
+        if self.erases:
+            sizes = {}
+            for addr, size in self.erases:
+                sizes[size] = sizes.get(size, 0) + 1
+            print("Coalesced erases: " + ', '.join(f'{n} x {size // KiB} KiB' for size, n in sorted(sizes.items())))
+        print(f"Estimated time: {self.estimate(upload_rate):.1f} s")
+
+
 class FIU(Block):
     FIU_CFG = 0
     BURST_CFG = 1
@@ -994,10 +1949,34 @@ class FIU(Block):
     UMA_ECTS = 0x1f
 
     MMFLASH_BASE = 0xc0000000
+    SECTOR_SIZE = 0x1000
+
+    ERASE_OPCODES = { 0x1000: 0x20, 0x8000: 0x52, 0x10000: 0xd8 }
+    CHIP_ERASE = 0xc7
+
+    # Known chips, by JEDEC ID, with typical erase times from the datasheets
+    CHIPS = {
+        (0xef, 0x40, 0x17): SPIFlashChip('Winbond W25Q64', 8*MiB,
+            { 0x1000: 0.045, 0x8000: 0.12, 0x10000: 0.15 }, 20),
+        (0xef, 0x40, 0x18): SPIFlashChip('Winbond W25Q128', 16*MiB,
+            { 0x1000: 0.045, 0x8000: 0.12, 0x10000: 0.15 }, 40),
+        (0xc2, 0x20, 0x17): SPIFlashChip('Macronix MX25L64', 8*MiB,
+            { 0x1000: 0.04, 0x8000: 0.2, 0x10000: 0.4 }, 25),
+        (0xc2, 0x20, 0x18): SPIFlashChip('Macronix MX25L128', 16*MiB,
+            { 0x1000: 0.04, 0x8000: 0.2, 0x10000: 0.4 }, 50),
+        (0x20, 0xba, 0x18): SPIFlashChip('Micron N25Q128', 16*MiB,
+            { 0x1000: 0.25, 0x10000: 0.7 }, 170),
+    }
+
+    STAGING_BASE = 0x01000000 # RAM area for data to be flashed by the monitor
+    STAGING_SIZE = 0x00400000
 
     def __init__(self, lolmon, base=None):
         super().__init__(lolmon, base)
         self.cs = 0
+        self.image = FlashImage()
+        self.chip = None
+        self.timings = [] # (operation, address, size, seconds)
 
     def dump(self):
         self.l.dump8(self.base, 0x20)
@@ -1006,11 +1985,12 @@ class FIU(Block):
         return self.read16(self.FWIN_LOW[i]) * 0x1000, self.read16(self.FWIN_HIGH[i]) * 0x1000
 
     def any_fwin_contains(self, x):
-        return any([x in range(*fiu.get_fwin(i)) for i in [1, 2, 3]])
+        return any([x in range(*self.get_fwin(i)) for i in [1, 2, 3]])
 
     def set_fwin(self, i, low, high):
         self.write16(self.FWIN_LOW[i], low // 0x1000)
         self.write16(self.FWIN_HIGH[i], high // 0x1000)
+        self.l.cache.invalidate(self.MMFLASH_BASE, 16*MiB)
 
     def get_uma_code(self):
         return self.read8(self.UMA_CODE)
@@ -1043,37 +2023,157 @@ class FIU(Block):
             cts |= self.CTS_RD_WR
         self.write8(self.UMA_CTS, cts)
         while self.read8(self.UMA_CTS) & self.CTS_EXEC_DONE:
-            print('lol')
+            pass
+
+    # One UMA transaction: A command code, optionally a 3-byte address, and up
+    # to four data bytes that are written or read.
+    #
+    # UMA_CODE...UMA_CTS are consecutive registers, so the whole transaction
+    # is set up and started by one wb command, ending with the CTS write. It
+    # is followed by a read of CTS, which gives the transaction time to finish
+    # and lets us check that it did, and for reads, of UMA_DB0..3.
+    class Transaction:
+        def __init__(self, code, addr=None, write=b'', read=0):
+            assert len(write) <= 4 and read <= 4 and not (write and read)
+            self.code = code
+            self.addr = addr
+            self.write = bytes(write)
+            self.read = read
+
+        def __repr__(self):
+            return 'Transaction(%#04x, %s, %s, %d)' % (self.code, self.addr, self.write, self.read)
+
+        def commands(self, fiu):
+            cts = fiu.CTS_EXEC_DONE | (fiu.cs << fiu.CTS_DEV_NUM_SHIFT)
+            cts |= (len(self.write) or self.read) << fiu.CTS_D_SIZE_SHIFT
+            addr = self.addr or 0
+            if self.addr is not None:
+                cts |= fiu.CTS_A_SIZE
+            if self.write:
+                cts |= fiu.CTS_RD_WR
+            values = [self.code, addr & 0xff, (addr >> 8) & 0xff, (addr >> 16) & 0xff]
+            values += list(self.write.ljust(4, b'\0')) + [cts]
+            cmds = ['wb %08x ' % (fiu.base + fiu.UMA_CODE) + ' '.join('%d' % v for v in values),
+                    'rb %08x' % (fiu.base + fiu.UMA_CTS)]
+            if self.read:
+                cmds.append('rb %08x %d' % (fiu.base + fiu.UMA_DB0, self.read))
+            return cmds
+
+        # Number of values that the commands print
+        def results(self):
+            return 1 + self.read
+
+    RDID = Transaction(0x9f, read=3)
+    RDSR = Transaction(0x05, read=1)
+    WREN = Transaction(0x06)
+
+    # Run a sequence of transactions (e.g. write enable, program, status
+    # poll) in as few commands as possible. Returns the data read by each.
+    def execute(self, *txns):
+        cmds = []
+        for txn in txns:
+            cmds += txn.commands(self)
+        values = self.l.parse_r_output(self.l.run_batch(cmds))
+
+        results = []
+        for txn in txns:
+            cts, data = values[0], bytes(values[1:txn.results()])
+            values = values[txn.results():]
+            if cts & self.CTS_EXEC_DONE:
+                print(f'FIU.execute: {txn} not done in time')
+                while self.read8(self.UMA_CTS) & self.CTS_EXEC_DONE:
+                    pass
+                if txn.read:
+                    data = self.read8(self.UMA_DB0, 4)[:txn.read]
+            results.append(data)
+        return results
 
     # Read chip ID
     def rdid(self):
-        self.set_uma_code(0x9f)
-        self.do_uma(False, False, 3)
-        return self.get_uma_data()[:3]
+        return list(self.execute(self.RDID)[0])
 
     # Read status register
     def rsr(self):
-        self.set_uma_code(0x05)
-        self.do_uma(False, False, 1)
-        return self.get_uma_data()[0]
+        return self.execute(self.RDSR)[0][0]
 
     # Write Enable
     def wren(self):
-        self.set_uma_code(0x06)
-        self.do_uma(False, False, 0)
+        self.execute(self.WREN)
+
+    # Program up to four bytes, and return the status register afterwards
+    def uma_program(self, addr, data):
+        addr = addr & 0xffffff
+        txns = [self.WREN, self.Transaction(0x02, addr, write=data), self.RDSR]
+        status = self.execute(*txns)[2][0]
+        self.image.program(addr, bytes(data))
+        self.l.cache.invalidate(addr | self.MMFLASH_BASE, len(data))
+        return status
+
+    # Identify the flash chip. Unknown chips get conservative guesses.
+    def detect_chip(self):
+        if not self.chip:
+            jedec = tuple(self.rdid())
+            if jedec in self.CHIPS:
+                self.chip = self.CHIPS[jedec].copy()
+            else:
+                size = 1 << jedec[2] if jedec[2] in range(0x10, 0x1a) else 16*MiB
+                self.chip = SPIFlashChip('unknown %02x%02x%02x' % jedec, size,
+                        { 0x1000: 0.4, 0x10000: 2.0 })
+        return self.chip
+
+    # Wait for the flash to finish an operation that typically takes
+    # `expected` seconds: Sleep through most of it, then poll the status
+    # register with an interval that grows as the operation overruns.
+    #   On Winbond: RSR-1.BUSY
+    #   On Macronix: SR.WIP
+    def wait_wip(self, expected):
+        start = time.monotonic()
+        time.sleep(expected * 0.8)
+        interval = expected / 20
+        while self.rsr() & 0x01:
+            time.sleep(interval)
+            interval = min(interval * 1.5, expected / 2)
+        return time.monotonic() - start
+
+    def record(self, op, addr, size, seconds):
+        self.timings.append((op, addr, size, seconds))
+
+    def timing_summary(self):
+        ops = {}
+        for op, addr, size, seconds in self.timings:
+            key = (op, size) if op == 'erase' else (op, 0)
+            ops.setdefault(key, []).append((size, seconds))
+        for (op, size), times in sorted(ops.items()):
+            total = sum(seconds for size, seconds in times)
+            line = f'{op:6} {size // KiB:6} KiB: ' if size else f'{op:17}: '
+            line += f'{len(times):5}x, avg {total / len(times) * 1000:8.1f} ms, '
+            line += f'max {max(seconds for size, seconds in times) * 1000:8.1f} ms'
+            if not size:
+                line += f', {sum(size for size, seconds in times) / total:.0f} B/s'
+            print(line)
+
+    # Erase a 4 KiB sector, 32/64 KiB block, or the whole chip
+    def erase(self, addr, size):
+        chip = self.detect_chip()
+        addr = addr & 0xffffff
+        assert addr % size == 0
+        if size == chip.size and chip.chip_erase_time:
+            self.execute(self.WREN, self.Transaction(self.CHIP_ERASE))
+            expected = chip.chip_erase_time
+        else:
+            assert size in chip.erase_times
+            self.execute(self.WREN, self.Transaction(self.ERASE_OPCODES[size], addr))
+            expected = chip.erase_times[size]
+
+        seconds = self.wait_wip(expected)
+        chip.learn(size, seconds)
+        self.record('erase', addr, size, seconds)
+        self.image.erase(addr, size)
+        self.l.cache.invalidate(addr | self.MMFLASH_BASE, size)
 
     # Sector Erase
     def erase4k(self, addr, cs=0):
-        self.wren()
-        self.set_uma_code(0x20)
-        self.set_uma_addr(addr)
-        self.do_uma(False, True, 0)
-
-        # Poll until the erase is done.
-        #   On Winbond: RSR-1.BUSY
-        #   On Macronix: SR.WIP
-        while self.rsr() & 0x01:
-            pass
+        self.erase(addr & 0xfff000, self.SECTOR_SIZE)
 
     # program at 8-bit width
     def prog8(self, addr, data):
@@ -1086,10 +2186,11 @@ class FIU(Block):
             print("prog %06x = %2x" % (addr, data))
             self.wren()
             self.l.write8(addr | self.MMFLASH_BASE, data)
+            self.image.program(addr, bytes([data]))
 
     def prog8_as_needed(self, addr, data):
         addr = addr & 0xffffff
-        fdata = self.mm_read(len(data))
+        fdata = self.read_flash(addr, len(data))
         for i in range(len(data)):
             if fdata[i] != data[i]:
                 self.prog8(addr+i, data[i])
@@ -1100,21 +2201,92 @@ class FIU(Block):
         addr = addr & 0xffffff
         assert addr & 0xfff == 0
         assert len(data) <= 0x1000
-        fdata = self.mm_read(len(data))
+        fdata = self.read_flash(addr, len(data))
         for i in range(len(data)):
             if ~fdata[i] & data[i]:
                 return True
         return False
 
-    # erase/reprogram a page or more as needed
-    def flash(self, addr, data):
+    # What a sector needs in order to go from old to new contents: Nothing,
+    # programming only (if only 1->0 transitions are needed), or an erase.
+    @staticmethod
+    def sector_op(old, new):
+        if old == new:
+            return 'skip'
+        o = int.from_bytes(old, 'little')
+        n = int.from_bytes(new, 'little')
+        if o & n == n:
+            return 'program'
+        return 'erase'
+
+    # Read flash contents through the host-side image. Sectors that aren't
+    # known yet are read through the memory-mapped window, in runs of up to
+    # READ_CHUNK bytes, and remembered.
+    READ_CHUNK = 0x10000
+
+    def read_flash(self, addr, length):
+        addr = addr & 0xffffff
+        missing = [i for i in self.image.sectors(addr, length) if not self.image.known[i]]
+        if missing:
+            fwin1 = self.get_fwin(1)
+            for first, end in contiguous_runs(missing):
+                for start in range(first * self.SECTOR_SIZE, end * self.SECTOR_SIZE, self.READ_CHUNK):
+                    size = min(self.READ_CHUNK, end * self.SECTOR_SIZE - start)
+                    print(f'\rReading flash at {start:06x}...', end='')
+                    self.set_fwin(1, start, start + size)
+                    self.image.update(start, self.l.read_data(start | self.MMFLASH_BASE, size))
+            self.set_fwin(1, *fwin1)
+            print(' done')
+        return self.image.read(addr, length)
+
+    # Sectors that already match by hash aren't read back
+    def plan_flash(self, addr, data):
         addr = addr & 0xffffff
         assert addr & 0xfff == 0
-        for p in range(0, len(data), 0x1000):
-            pdata = data[p:p+0x1000]
-            if self.page_needs_erase(addr+p, pdata):
-                self.erase4k(addr+p)
-            self.prog8_as_needed(addr+p, pdata)
+        S = self.SECTOR_SIZE
+        stale = [(addr + p) // S for p in range(0, len(data), S)
+                 if not self.image.matches(addr + p, data[p:p+S])]
+        for first, end in contiguous_runs(stale):
+            self.read_flash(first * S, min(end * S, addr + len(data)) - first * S)
+        return FlashPlan(addr, data, self.image.read(addr, len(data)), self.image, self.detect_chip())
+
+    # erase/reprogram a page or more as needed
+    #
+    # The data is compared against the host-side flash image. Coalesced block
+    # and chip erases are done first. Then, runs of sectors that need to
+    # change are staged in RAM with upload(memaddr, data), which defaults to
+    # serial writes (emc0.push_data is much faster), and written by the
+    # monitor's fl command, which erases remaining sectors where needed.
+    def flash(self, addr, data, upload=None, upload_rate=None):
+        plan = self.plan_flash(addr, data)
+        plan.summary(upload_rate)
+        ops = dict(plan.ops)
+        upload = upload or self.l.write_data
+        start = time.monotonic()
+
+        for erase_addr, size in plan.erases:
+            print(f'Erasing {size // KiB} KiB at {erase_addr:06x}')
+            self.erase(erase_addr, size)
+
+        written = 0
+        for offset, length in plan.runs(self.STAGING_SIZE):
+            upload(self.STAGING_BASE, data[offset:offset+length])
+            t = time.monotonic()
+            self.l.flash(self.STAGING_BASE, plan.addr + offset, length)
+            self.record('fl', plan.addr + offset, length, time.monotonic() - t)
+            self.image.update(plan.addr + offset, data[offset:offset+length])
+            written += length
+
+            # fl erases whole sectors, including the part after a run that
+            # ends within a sector
+            end = plan.addr + offset + length
+            if end % self.SECTOR_SIZE and ops[(offset + length - 1) & ~(self.SECTOR_SIZE - 1)] == 'erase':
+                self.image.erase(end, self.SECTOR_SIZE - end % self.SECTOR_SIZE)
+
+        elapsed = time.monotonic() - start
+        print(f"Wrote {written} of {len(data)} bytes in {elapsed:.1f} s, "
+              f"{written / max(elapsed, 1e-6):.0f} B/s written, "
+              f"{len(data) / max(elapsed, 1e-6):.0f} B/s overall")
 
     def mm_read(self, addr, data_len):
         addr = addr & 0xffffff
@@ -1126,17 +2298,33 @@ class FIU(Block):
 
     # perform READ using UMA
     def uma_read(self, addr, data_len=4):
-        self.set_uma_code(0x03)
-        self.set_uma_addr(addr)
-        self.do_uma(False, True, data_len)
-        return self.get_uma_data()
+        return list(self.execute(self.Transaction(0x03, addr, read=data_len))[0])
 
     # perform FAST READ using UMA. FIU automatically inserts the dummy byte
     def uma_fast_read(self, addr, data_len=4):
-        self.set_uma_code(0x0b)
-        self.set_uma_addr(addr)
-        self.do_uma(False, True, data_len)
-        return self.get_uma_data()
+        return list(self.execute(self.Transaction(0x0b, addr, read=data_len))[0])
+
+    # Read any flash range through UMA, including regions outside the flash
+    # windows. With the monitor's ur command, the device reads into RAM at
+    # STAGING_BASE in a tight loop, and the result is fetched with read
+    # (serial by default; emc0.pull_data is faster). Otherwise, 4-byte READ
+    # transactions are issued from here, in batches.
+    def uma_read_bulk(self, addr, length, read=None):
+        addr = addr & 0xffffff
+        data = b''
+        if self.l.has_command('ur'):
+            read = read or self.l.read_data
+            for offset in range(0, length, self.STAGING_SIZE):
+                n = min(self.STAGING_SIZE, length - offset)
+                self.l.run_command('ur %06x %08x %d' % (addr + offset, self.STAGING_BASE, n))
+                self.l.cache.invalidate(self.STAGING_BASE, n)
+                data += read(self.STAGING_BASE, n)
+        else:
+            for offset in range(0, length, 0x400):
+                txns = [self.Transaction(0x03, addr + i, read=min(4, length - i))
+                        for i in range(offset, min(offset + 0x400, length), 4)]
+                data += b''.join(self.execute(*txns))
+        return data
 
     def uma_assert(self):
         x = self.read8(self.UMA_ECTS)
@@ -1202,6 +2390,95 @@ class FIU(Block):
         self.set_read_burst(16)
         self.setclr32(0x14, 6, 1)
 
+    # Back up the whole flash into a file, reading through the memory-mapped
+    # window in BACKUP_CHUNK pieces, over Ethernet if the EMC is set up and
+    # the host answers, otherwise over serial.
+    #
+    # The file is preallocated and written through mmap, and finished chunks
+    # are checkpointed in filename.progress, so an interrupted backup resumes
+    # where it stopped. If the monitor has the crc command, erased sectors are
+    # recognized on the device and not transferred, and everything that is
+    # transferred is verified.
+    BACKUP_CHUNK = 0x10000
+
+    def backup(self, filename, size=None, emc=None):
+        size = size or self.detect_chip().size
+        chunks = (size + self.BACKUP_CHUNK - 1) // self.BACKUP_CHUNK
+        progress_name = filename + '.progress'
+        erased_crc = zlib.crc32(b'\xff' * self.SECTOR_SIZE)
+
+        self.make_fast()
+        emc = emc0 if emc is None else emc
+        if emc and hasattr(emc, 'rx_bufs') and (getattr(emc, 'pull_socket', None) or emc.pull_setup()):
+            read = emc.pull_data
+            print('Reading through Ethernet')
+        else:
+            read = self.l.read_data
+            print('Reading through serial')
+
+        if (os.path.exists(filename) and os.path.getsize(filename) == size and
+                os.path.exists(progress_name)):
+            with open(progress_name, 'rb') as f:
+                progress = bytearray(f.read().ljust(chunks, b'\0')[:chunks])
+            print(f'Resuming, {sum(progress)}/{chunks} chunks done')
+        else:
+            progress = bytearray(chunks)
+            with open(filename, 'wb') as f:
+                f.truncate(size)
+            with open(progress_name, 'wb') as f:
+                f.write(progress)
+
+        fwin1 = self.get_fwin(1)
+        self.set_fwin(1, 0, size)
+        start = time.monotonic()
+        transferred = skipped = 0
+        with open(filename, 'r+b') as f, open(progress_name, 'r+b') as pf:
+            mm = mmap.mmap(f.fileno(), size)
+            for i in range(chunks):
+                if progress[i]:
+                    continue
+                addr = i * self.BACKUP_CHUNK
+                length = min(self.BACKUP_CHUNK, size - addr)
+                crcs = self.l.crc32(self.MMFLASH_BASE + addr, length, self.SECTOR_SIZE)
+                if crcs:
+                    todo = [n for n, crc in enumerate(crcs) if crc != erased_crc]
+                    for n in range(len(crcs)):
+                        if n not in todo:
+                            p = addr + n * self.SECTOR_SIZE
+                            mm[p:p+self.SECTOR_SIZE] = b'\xff' * self.SECTOR_SIZE
+                            skipped += self.SECTOR_SIZE
+                else:
+                    todo = range((length + self.SECTOR_SIZE - 1) // self.SECTOR_SIZE)
+
+                for first, end in contiguous_runs(todo):
+                    p = addr + first * self.SECTOR_SIZE
+                    n = min(end * self.SECTOR_SIZE, length) - first * self.SECTOR_SIZE
+                    for attempt in range(3):
+                        data = read(self.MMFLASH_BASE + p, n)
+                        if data is None:
+                            raise IOError(f'Reading flash at {p:06x} failed')
+                        if not crcs or all(zlib.crc32(data[k:k+self.SECTOR_SIZE]) == crcs[first + k // self.SECTOR_SIZE]
+                                           for k in range(0, n, self.SECTOR_SIZE)):
+                            break
+                        print(f'\nCRC mismatch at {p:06x}, retrying')
+                    else:
+                        raise IOError(f'Reading flash at {p:06x} failed')
+                    mm[p:p+n] = data
+                    transferred += n
+
+                progress[i] = 1
+                pf.seek(i)
+                pf.write(b'\1')
+                pf.flush()
+                elapsed = time.monotonic() - start
+                print(f'\rBackup: {sum(progress)}/{chunks} chunks, {transferred} bytes transferred, '
+                      f'{skipped} erased bytes skipped, {transferred / max(elapsed, 1e-6):.0f} B/s', end='')
+            mm.flush()
+            mm.close()
+        self.set_fwin(1, *fwin1)
+        os.remove(progress_name)
+        print(' done')
+
     def cs3test(self, i):
         # Trying to figure out what determines the output level of CS3 aka. GPIO 2.2
         # Possible influences:
@@ -1251,6 +2528,8 @@ class Timers(Block):
     TCSR_CEN    = BIT(30)
     TCSR_FREEZE = BIT(31)
 
+    TDR_MASK    = 0xffffff
+
     def summary(self):
         for i in range(5):
             tcsr = self.read32(self.TCSR[i])
@@ -1266,6 +2545,18 @@ class Timers(Block):
             self.write32(self.TICR[i], 1000000)
             self.write32(self.TCSR[i], 239 | self.TCSR_CACT | self.TCSR_PER | self.TCSR_CEN)
 
+    # Let a timer count down through its full 24-bit range, over and over
+    def start_free_running(self, timer, prescale=0):
+        self.write32(self.TICR[timer], self.TDR_MASK)
+        self.write32(self.TCSR[timer], prescale | self.TCSR_PER | self.TCSR_CEN)
+
+    # Measure the tick rate of a running timer against the host clock
+    def ticks_per_second(self, timer, interval=0.2):
+        t0, a = time.time(), self.read32(self.TDR[timer])
+        time.sleep(interval)
+        t1, b = time.time(), self.read32(self.TDR[timer])
+        return ((a - b) & self.TDR_MASK) / (t1 - t0)
+
     def is_decrementing(self, timer):
         a = self.read32(self.TDR[timer])
         b = self.read32(self.TDR[timer])
@@ -1289,12 +2580,20 @@ class GPIO(Block):
     def dump(self):
         self.l.dump32(self.base, 0x40)
 
+    # Read all configuration and data registers with one command, and return
+    # a function that looks up register values by offset
+    def snapshot(self):
+        first, last = self.CFG0[0], self.DATAIN[-1]
+        words = self.read32(first, (last - first) // 4 + 1)
+        return lambda offset: words[(offset - first) // 4] if offset is not None else 0
+
     def dump_well(self):
+        regs = self.snapshot()
         def g(bank, offset):
-            if self.get_dir(bank, offset):
-                return f'W{self.get_dataout(bank, offset)}'
+            if regs(self.CFG0[bank]) & BIT(offset):
+                return f'W{0 + bool(regs(self.DATAOUT[bank]) & BIT(offset))}'
             else:
-                return f'R{self.read(bank, offset)}'
+                return f'R{0 + bool(regs(self.DATAIN[bank]) & BIT(offset))}'
 
         for bank in range(8):
             print(f'Bank {bank}: ' + ' '.join([g(bank, i) for i in range(self.COUNTS[bank])]))
@@ -1318,8 +2617,380 @@ class GPIO(Block):
         self.setclr32(self.CFG0[bank], offset, value)
 
 
+# Write value changes in VCD format, as they happen
+class VCDWriter:
+    def __init__(self, f, signals, timescale='1 us'):
+        self.f = f
+        self.ids = {}
+        f.write('$timescale %s $end\n$scope module lolmon $end\n' % timescale)
+        for n, name in enumerate(signals):
+            self.ids[name] = ''.join(chr(33 + (n // 94 ** i) % 94)
+                                     for i in range(1 + (n >= 94)))
+            f.write('$var wire 1 %s %s $end\n' % (self.ids[name], name))
+        f.write('$upscope $end\n$enddefinitions $end\n')
+
+    def change(self, t, values):
+        if values:
+            self.f.write('#%d\n' % t)
+            for name, value in values.items():
+                self.f.write('%d%s\n' % (value, self.ids[name]))
+
+
+# A cheap logic analyzer: sample the DATAIN registers of the selected banks
+# with one command line per sample, and stream transitions to a VCD file.
+#
+# masks maps bank numbers to bit masks of the pins to watch (default: all
+# pins). rate limits the number of samples per second (default: as fast as
+# the link allows). Samples are timestamped on the host, or, if a timer is
+# given, with that timer's TDR, read in the same command line.
+class GPIOSampler:
+    def __init__(self, gpio, masks=None, rate=None, timer=None):
+        self.gpio = gpio
+        self.masks = masks or { bank: BIT(n) - 1 for bank, n in enumerate(gpio.COUNTS) }
+        self.rate = rate
+        self.timer = timer
+        self.banks = sorted(bank for bank, mask in self.masks.items() if mask)
+
+        # Read adjacent registers with one command
+        addrs = [gpio.base + gpio.DATAIN[bank] for bank in self.banks]
+        if timer is not None:
+            addrs.append(tmr.base + tmr.TDR[timer])
+        self.cmds = []
+        for start, end in contiguous_runs([addr // 4 for addr in addrs]):
+            self.cmds.append('rw %08x %d' % (start * 4, end - start))
+
+    def pins(self):
+        return ['gpio%d_%d' % (bank, pin) for bank in self.banks
+                for pin in range(self.gpio.COUNTS[bank]) if self.masks[bank] & BIT(pin)]
+
+    # One sample: (timestamp in microseconds, { pin: value })
+    def sample(self):
+        t = time.time()
+        words = self.gpio.l.parse_r_output(self.gpio.l.run_batch(self.cmds))
+        if self.timer is not None:
+            # The 24-bit counter wraps around within a fraction of a second,
+            # which can be less than the sampling interval, so the whole wraps
+            # are counted with the host's clock
+            tdr = words.pop()
+            delta = (self.tdr - tdr) & tmr.TDR_MASK
+            period = tmr.TDR_MASK + 1
+            delta += round(((t - self.host_t) * self.tick_rate - delta) / period) * period
+            self.ticks += delta
+            self.tdr = tdr
+            self.host_t = t
+            t = self.ticks / self.tick_rate
+        values = {}
+        for bank, word in zip(self.banks, words):
+            for pin in range(self.gpio.COUNTS[bank]):
+                if self.masks[bank] & BIT(pin):
+                    values['gpio%d_%d' % (bank, pin)] = 0 + bool(word & BIT(pin))
+        return int((t - self.t0) * 1000000), values
+
+    # Sample until duration (in seconds) is over, or until interrupted
+    def run(self, filename, duration=None):
+        self.t0 = time.time()
+        if self.timer is not None:
+            tmr.start_free_running(self.timer)
+
+            # Counting wraps needs the tick rate to be accurate over the whole
+            # sampling interval, so prefer the reference clock to a measurement
+            self.tick_rate = clk.rate_ref()
+            measured = tmr.ticks_per_second(self.timer)
+            if abs(measured / self.tick_rate - 1) > 0.1:
+                print('Timer runs at %.0f Hz instead of %.0f Hz, using the measured rate' %
+                      (measured, self.tick_rate))
+                self.tick_rate = measured
+            self.host_t = time.time()
+            self.tdr = tmr.read32(tmr.TDR[self.timer])
+            self.ticks = 0
+            self.t0 = 0
+
+        samples = changes = 0
+        state = {}
+        start = time.time()
+        with open(filename, 'w') as f:
+            vcd = VCDWriter(f, self.pins())
+            try:
+                while duration is None or time.time() - start < duration:
+                    t, values = self.sample()
+                    diff = { pin: v for pin, v in values.items() if state.get(pin) != v }
+                    vcd.change(t, diff)
+                    state.update(diff)
+                    samples += 1
+                    changes += len(diff) if samples > 1 else 0
+                    if self.rate:
+                        delay = start + samples / self.rate - time.time()
+                        if delay > 0:
+                            time.sleep(delay)
+            except KeyboardInterrupt:
+                pass
+
+        elapsed = time.time() - start
+        print('%d samples in %.1f s (%.1f/s), %d transitions' %
+              (samples, elapsed, samples / elapsed, changes))
+
+# Measure how long code on the board runs, with a free-running timer.
+# The command under test is bracketed by two copies of the timer's TDR to
+# SCRATCH, all on one command line, so that serial latency doesn't count.
+# The cost of the bracket itself is measured once and subtracted.
+class Profiler:
+    SCRATCH = 0x00200000
+
+    def __init__(self, timer=1, prescale=0):
+        self.l = tmr.l
+        self.timer = timer
+        self.tdr = tmr.base + tmr.TDR[timer]
+        tmr.start_free_running(timer, prescale)
+
+        # The timers run from the reference clock; check that against the host
+        self.tick_rate = clk.rate_ref() / (prescale + 1)
+        measured = tmr.ticks_per_second(timer)
+        if abs(measured / self.tick_rate - 1) > 0.1:
+            print('Timer runs at %.0f Hz instead of %.0f Hz, using the measured rate' %
+                  (measured, self.tick_rate))
+            self.tick_rate = measured
+        self.cpu_rate = clk.rate_cpu()
+
+        self.overhead = 0
+        self.overhead = min(self.measure('')[0] for i in range(5))
+
+    # Run cmd once, and return (ticks, output)
+    def measure(self, cmd):
+        line = 'cw %08x %08x 1;' % (self.tdr, self.SCRATCH)
+        if cmd:
+            line += cmd + ';'
+        line += 'cw %08x %08x 1' % (self.tdr, self.SCRATCH + 4)
+        assert len(line) <= self.l.MAX_LINE
+
+        # cmd may write memory, and the cw commands write the scratch words
+        self.l.cache.invalidate_writable()
+        start = time.time()
+        output = self.l.run_command(line)
+        if time.time() - start > (tmr.TDR_MASK + 1) / self.tick_rate:
+            print('Warning: the timer may have wrapped around; use a larger prescaler')
+        a, b = self.l.read32(self.SCRATCH, 2)
+        return ((a - b) & tmr.TDR_MASK) - self.overhead, output
+
+    # Run cmd several times, print statistics, and return the run times in seconds
+    def profile(self, cmd, runs=10):
+        times = [self.measure(cmd)[0] / self.tick_rate for i in range(runs)]
+        mean = statistics.mean(times)
+        stdev = statistics.stdev(times) if runs > 1 else 0
+        print('%s: %d runs' % (cmd, runs))
+        for name, t in [('min', min(times)), ('median', statistics.median(times)),
+                        ('mean', mean), ('max', max(times))]:
+            print(f'  {name:6}  {t * 1e6:12.2f} us  {t * self.cpu_rate:12.0f} cycles')
+        print(f'  stdev   {stdev * 1e6:12.2f} us')
+        return times
+
+    def call(self, addr, a=0, b=0, c=0, runs=10):
+        return self.profile('call %x %d %d %d' % (addr, a, b, c), runs)
+
+    def src(self, addr, runs=10):
+        return self.profile('src %x' % addr, runs)
+
+# Find the parts of a memory range that change, like src/linux/memscan.c, but
+# from the host. Each round, CRCs of BLOCK-sized blocks are computed on the
+# device and compared with the snapshot. Blocks that differ are split by
+# FANOUT until they are MIN_BLOCK bytes, and only those are read. Without the
+# crc command, or with use_crc=False (crc reads bytes, which some registers
+# don't like), the whole range is read every round.
+class MemScanner:
+    BLOCK = 0x1000
+    FANOUT = 8
+    MIN_BLOCK = 0x20
+
+    def __init__(self, lolmon, addr, length, use_crc=True):
+        assert addr % 4 == 0 and length % 4 == 0
+        self.l = lolmon
+        self.addr = addr
+        self.length = length
+        self.use_crc = use_crc and lolmon.has_command('crc')
+        self.snapshot()
+
+    def snapshot(self):
+        self.l.cache.invalidate(self.addr, self.length)
+        self.data = bytearray(self.l.read_data(self.addr, self.length))
+
+    # Blocks (addr, length) that differ from the snapshot, by CRC. Each level
+    # of subdivision takes one batch of crc commands.
+    def changed_blocks(self):
+        blocks = [(self.addr, self.length)]
+        block = self.BLOCK
+        while blocks:
+            cmds = ['crc %08x %d %d' % (addr, length, block) for addr, length in blocks]
+            crcs = iter(self.l.parse_r_output(self.l.run_batch(cmds)))
+            changed = []
+            for addr, length in blocks:
+                for a in range(addr, addr + length, block):
+                    size = min(block, addr + length - a)
+                    offset = a - self.addr
+                    if next(crcs) != zlib.crc32(self.data[offset:offset+size]):
+                        changed.append((a, size))
+            if block == self.MIN_BLOCK:
+                return changed
+            blocks = changed
+            block = max(block // self.FANOUT, self.MIN_BLOCK)
+        return []
+
+    def read_blocks(self, blocks):
+        words = self.l.parse_r_output(self.l.run_batch(['rw %08x %d' % (addr, size // 4)
+                                                        for addr, size in blocks]))
+        return struct.pack('<%dI' % len(words), *words)
+
+    # One round: returns the changed ranges as (addr, before, after), and
+    # updates the snapshot
+    def scan(self):
+        if self.use_crc:
+            blocks = self.changed_blocks()
+            new = self.read_blocks(blocks)
+        else:
+            self.l.cache.invalidate(self.addr, self.length)
+            blocks = [(self.addr, self.length)]
+            new = self.l.read_data(self.addr, self.length)
+
+        changes = []
+        pos = 0
+        for addr, size in blocks:
+            self.diff(addr, new[pos:pos+size], changes)
+            pos += size
+        return changes
+
+    # Compare word by word, and merge adjacent changed words into ranges
+    def diff(self, addr, new, changes):
+        offset = addr - self.addr
+        old = bytes(self.data[offset:offset+len(new)])
+        for chunk in range(0, len(new), self.MIN_BLOCK):
+            if new[chunk:chunk+self.MIN_BLOCK] == old[chunk:chunk+self.MIN_BLOCK]:
+                continue
+            for i in range(chunk, min(chunk + self.MIN_BLOCK, len(new)), 4):
+                if new[i:i+4] == old[i:i+4]:
+                    continue
+                a = addr + i
+                if changes and changes[-1][0] + len(changes[-1][1]) == a:
+                    start, before, after = changes[-1]
+                    changes[-1] = (start, before + old[i:i+4], after + new[i:i+4])
+                else:
+                    changes.append((a, old[i:i+4], new[i:i+4]))
+        self.data[offset:offset+len(new)] = new
+
+    # Scan until interrupted (or for a number of rounds), and print the
+    # changes as 32-bit words
+    def run(self, interval=0, rounds=None):
+        words = lambda data: ' '.join('%08x' % w for w in struct.unpack('<%dI' % (len(data) // 4), data))
+        n = 0
+        try:
+            while rounds is None or n < rounds:
+                for addr, before, after in self.scan():
+                    print('%08x: %s -> %s' % (addr, words(before), words(after)))
+                n += 1
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+
+# General-purpose DMA controller, with two channels. The register layout is
+# the one of the GDMA in other Nuvoton SoCs (W90P710, NPCM7xx).
+#
+# Transfers are software requests in memory-to-memory mode; a chain of
+# transfers is spread over both channels, and each channel gets its next
+# transfer as soon as it is done. Set l.dma = gdma to let Lolmon.copy8/16/32
+# and memset offload large transfers.
+class GDMA(Block):
+    CHANNELS = 2
+    CTL   = [ 0x00, 0x20 ]
+    SRCB  = [ 0x04, 0x24 ]
+    DSTB  = [ 0x08, 0x28 ]
+    TCNT  = [ 0x0c, 0x2c ]
+    CSRC  = [ 0x10, 0x30 ]
+    CDST  = [ 0x14, 0x34 ]
+    CTCNT = [ 0x18, 0x38 ]
+
+    CTL_GDMAEN    = BIT(0)
+    CTL_DADIR     = BIT(4)
+    CTL_SADIR     = BIT(5)
+    CTL_DAFIX     = BIT(6)
+    CTL_SAFIX     = BIT(7)
+    CTL_TWS_SHIFT = 12
+    CTL_SOFTREQ   = BIT(16)
+    CTL_TC        = BIT(18)
+    CTL_GDMAERR   = BIT(20)
+
+    TWS = { 1: 0, 2: 1, 4: 2 }
+    MAX_COUNT = 0xffffff # transfers of the selected width
 
-USB = KCS = GDMA = AES = UART = SMB = PWM = MFT = Block
+    def __init__(self, lolmon, base=None):
+        super().__init__(lolmon, base)
+        self.busy = [ False ] * self.CHANNELS
+
+    def submit(self, channel, dest, src, count, width=4, fixed_src=False):
+        ctl = self.CTL_GDMAEN | self.CTL_SOFTREQ | (self.TWS[width] << self.CTL_TWS_SHIFT)
+        if fixed_src:
+            ctl |= self.CTL_SAFIX
+        self.l.run_batch([
+            'ww %08x %#x %#x %#x' % (self.base + self.SRCB[channel], src, dest, count),
+            'ww %08x %#x' % (self.base + self.CTL[channel], ctl)])
+        self.busy[channel] = True
+
+    # Wait for the transfer on a channel to finish, and disable the channel.
+    # Returns False on errors and timeouts.
+    def wait(self, channel, timeout=5):
+        if not self.busy[channel]:
+            return True
+        self.busy[channel] = False
+        start = time.time()
+        while True:
+            ctl, src, dest, count, csrc, cdst, ctcnt = self.read32(self.CTL[channel], 7)
+            if ctl & self.CTL_GDMAERR:
+                print('GDMA%d: error at %08x -> %08x' % (channel, csrc, cdst))
+                break
+            if ctl & self.CTL_TC or (ctcnt == 0 and not ctl & self.CTL_SOFTREQ):
+                self.write32(self.CTL[channel], 0)
+                return True
+            if time.time() - start > timeout:
+                print('GDMA%d: timeout, %d of %d left' % (channel, ctcnt, count))
+                break
+        self.write32(self.CTL[channel], 0)
+        return False
+
+    # Run a chain of (dest, src, count, width, fixed_src) transfers. They
+    # must be independent of each other, because two can run at once.
+    def run(self, transfers, channels=None):
+        channels = channels or list(range(self.CHANNELS))
+        ok = True
+        for i, transfer in enumerate(transfers):
+            channel = channels[i % len(channels)]
+            ok = self.wait(channel) and ok
+            self.submit(channel, *transfer)
+        for channel in channels:
+            ok = self.wait(channel) and ok
+        return ok
+
+    def chunks(self, dest, src, num, width, fixed_src=False):
+        transfers = []
+        for pos in range(0, num, self.MAX_COUNT):
+            n = min(self.MAX_COUNT, num - pos)
+            offset = 0 if fixed_src else pos * width
+            transfers.append((dest + pos * width, src + offset, n, width, fixed_src))
+        return transfers
+
+    # Copy num units of width bytes. Overlapping copies use one channel, so
+    # that the chunks happen in order.
+    def copy(self, dest, src, num, width=4):
+        if num == 0:
+            return True
+        overlap = dest < src + num * width and src < dest + num * width
+        return self.run(self.chunks(dest, src, num, width), [0] if overlap else None)
+
+    # Fill num words with value: the first word is written directly, and the
+    # rest is copied from it, with a fixed source address
+    def fill(self, addr, value, num):
+        if num == 0:
+            return True
+        self.l.write32(addr, value)
+        return self.run(self.chunks(addr + 4, addr, num - 1, 4, fixed_src=True))
+
+
+USB = KCS = AES = UART = SMB = PWM = MFT = Block
 PECI = GFXI = SSPI = AIC = ADC = SDHC = ROM = Block
 
 
@@ -1359,4 +3030,7 @@ fiu  = FIU(l, 0xc8000000)
 shm  = SHM(l, 0xc8001000)
 rom  = ROM(l, 0xffff0000)
 
+l.cache.add_region(rom.base, 0x10000)
+l.cache.add_region(FIU.MMFLASH_BASE, 16*MiB)
+
 emc0.init()
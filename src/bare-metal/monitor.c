@@ -27,6 +27,18 @@ static void write32(unsigned long addr, uint32_t value) { *(volatile uint32_t *)
 #define GPIO_BASE 0xb8003000
 #define CLK_BASE  0xb0000200
 
+/*
+ * Set the baud rate divisor. The -2 is a Nuvoton-specific quirk: the
+ * effective divisor is two more than the value in the divisor latch.
+ */
+static void uart_set_divisor(uint32_t div)
+{
+	write32(UART_BASE + 0x0c, 0x80);              // enable divisor latch
+	write32(UART_BASE + 0x00, (div - 2) & 0xff);  // low byte
+	write32(UART_BASE + 0x04, (div - 2) >> 8);    // high byte
+	write32(UART_BASE + 0x0c, 0x03);              // disable divisor latch; set 8n1
+}
+
 static void uart_init(void)
 {
 	/* Configure UART clock to a know-good state */
@@ -35,14 +47,8 @@ static void uart_init(void)
 	uint32_t clken = read32(CLK_BASE + 0);
 	write32(CLK_BASE + 0, clken | (1 << 11));       // CLKEN.UART0 = enable
 
-	/*
-	 * Set divisor to 13 (24MHz / 16 / 13 = 115384Hz. Close enough.)
-	 * The -2 is a Nuvoton-specific quirk.
-	 */
-	write32(UART_BASE + 0x0c, 0x80);   // enable divisor latch
-	write32(UART_BASE + 0x00, 13 - 2); // low byte
-	write32(UART_BASE + 0x04, 0);      // high byte
-	write32(UART_BASE + 0x0c, 0x03);   // disable divisor latch; set 8n1
+	/* Set divisor to 13 (24MHz / 16 / 13 = 115384Hz. Close enough.) */
+	uart_set_divisor(13);
 
 	/* Clear and initialize UART FIFOs */
 	write32(UART_BASE + 0x08, 0x87);   // RX trigger = 8 bytes; Reset/enable both FIFOs
@@ -227,6 +233,26 @@ static void *memcpy(void *d, const void *s, size_t n)
 	return d;
 }
 
+/* CRC-32 (IEEE 802.3), as computed by zlib's crc32(), using a small table */
+static uint32_t crc32(unsigned long addr, size_t len)
+{
+	static const uint32_t table[16] = {
+		0x00000000, 0x1db71064, 0x3b6e20c8, 0x26d930ac,
+		0x76dc4190, 0x6b6b51f4, 0x4db26158, 0x5005713c,
+		0xedb88320, 0xf00f9344, 0xd6d6a3e8, 0xcb61b38c,
+		0x9b64c2b0, 0x86d3d2d4, 0xa00ae278, 0xbdbdf21c,
+	};
+	uint32_t crc = ~0;
+
+	for (size_t i = 0; i < len; i++) {
+		crc ^= read8(addr + i);
+		crc = (crc >> 4) ^ table[crc & 15];
+		crc = (crc >> 4) ^ table[crc & 15];
+	}
+
+	return ~crc;
+}
+
 /* Parse a number, similar to strtol. base 0 means auto-detect */
 static bool parse_int(const char *s, uint32_t base, uint32_t *result)
 {
@@ -397,6 +423,23 @@ static bool fiu_page_needs_erase(uint32_t addr, const uint8_t *data, size_t coun
 	return false;
 }
 
+/* Read flash with UMA READ commands, four bytes at a time. Unlike the
+   memory-mapped windows, this reaches any flash address. */
+static void fiu_uma_read(uint32_t addr, uint8_t *dest, size_t count)
+{
+	fiu_set_uma_code(0x03);
+
+	for (size_t i = 0; i < count; i += 4) {
+		size_t chunk = min(4, count - i);
+
+		fiu_set_uma_addr(addr + i);
+		fiu_do_uma(false, true, chunk);
+
+		for (size_t j = 0; j < chunk; j++)
+			dest[i + j] = read8(FIU_UMA_DB0 + j);
+	}
+}
+
 static void fiu_flash(const uint8_t *data, uint32_t addr, size_t count)
 {
 	uint16_t fwin1_low = read16(FIU_FWIN1_LOW);
@@ -651,6 +694,147 @@ static void cmd_flash(int argc, char **argv)
 	fiu_flash((const uint8_t *)src, dest, count);
 }
 
+static void cmd_crc(int argc, char **argv)
+{
+	uint32_t addr, count, block, pos = 0;
+
+	if (argc != 3 && argc != 4) {
+		puts("Usage error");
+		return;
+	}
+
+	if (!parse_int(argv[1], 16, &addr))
+		return;
+	if (!parse_int(argv[2], 0, &count))
+		return;
+
+	block = count;
+	if (argc == 4 && !parse_int(argv[3], 0, &block))
+		return;
+
+	if (block == 0) {
+		puts("Usage error");
+		return;
+	}
+
+	/* One CRC per block, eight per line, in the same format as rw */
+	for (uint32_t offset = 0; offset < count; offset += block) {
+		if (pos == 0) {
+			if (offset)
+				putchar('\n');
+			put_hex32(addr + offset);
+			putstr(": ");
+		} else {
+			putchar(' ');
+		}
+
+		put_hex32(crc32(addr + offset, min(block, count - offset)));
+
+		if (++pos == 8)
+			pos = 0;
+	}
+
+	putchar('\n');
+}
+
+static void cmd_find(int argc, char **argv)
+{
+	uint32_t addr, count, max = 256, matches = 0, value;
+	uint8_t pattern[32];
+	size_t len = 0;
+
+	if (argc != 4 && argc != 5) {
+		puts("Usage error");
+		return;
+	}
+
+	if (!parse_int(argv[1], 16, &addr))
+		return;
+	if (!parse_int(argv[2], 0, &count))
+		return;
+	if (argc == 5 && !parse_int(argv[4], 0, &max))
+		return;
+
+	/* The pattern is given as hex bytes, without spaces */
+	for (const char *p = argv[3]; *p; p += 2) {
+		char byte[3] = { p[0], p[1], 0 };
+
+		if (!p[1] || len == sizeof(pattern)) {
+			puts("Invalid pattern");
+			return;
+		}
+		if (!parse_int(byte, 16, &value))
+			return;
+		pattern[len++] = value;
+	}
+
+	if (len == 0 || count < len)
+		return;
+
+	/* Print the address of each match, one per line, up to max */
+	for (uint32_t offset = 0; offset <= count - len && matches < max; offset++) {
+		size_t i;
+
+		for (i = 0; i < len; i++)
+			if (read8(addr + offset + i) != pattern[i])
+				break;
+
+		if (i == len) {
+			put_hex32(addr + offset);
+			putchar('\n');
+			matches++;
+		}
+	}
+}
+
+static void cmd_uma_read(int argc, char **argv)
+{
+	size_t src, dest, count;
+
+	if (argc != 4) {
+		puts("Usage error");
+		return;
+	}
+
+	if (!parse_int(argv[1], 16, &src))
+		return;
+	if (!parse_int(argv[2], 16, &dest))
+		return;
+	if (!parse_int(argv[3], 0, &count))
+		return;
+
+	if (count > 0x1000000 || src + count > 0x1000000) {
+		puts("Too big");
+		return;
+	}
+
+	fiu_uma_read(src, (uint8_t *)dest, count);
+}
+
+static void cmd_baud(int argc, char **argv)
+{
+	uint32_t div;
+
+	if (argc != 2) {
+		puts("Usage error");
+		return;
+	}
+
+	if (!parse_int(argv[1], 0, &div))
+		return;
+
+	if (div < 2 || div > 0xffff + 2) {
+		puts("Invalid divisor");
+		return;
+	}
+
+	/* Let the transmitter drain, so that no character is sent half-way through the switch */
+	while (!(read32(UART_BASE + 0x14) & 0x40))
+		;
+
+	uart_set_divisor(div);
+}
+
 void instruction_memory_barrier(void);
 static void cmd_imb(int argc, char **argv)
 {
@@ -733,6 +917,10 @@ static const struct command commands[] = {
 	{ "ch", "source destination count", "Copy one or more half-words (16-bit)", cmd_copy },
 	{ "cw", "source destination count", "Copy one or more words (32-bit)", cmd_copy },
 	{ "fl", "source destination count", "Write data to flash; destination must be 4k-aligned", cmd_flash },
+	{ "ur", "source destination count", "Read flash into memory through UMA", cmd_uma_read },
+	{ "crc", "address count [blocksize]", "Print the CRC-32 of memory, per block", cmd_crc },
+	{ "find", "address count hexpattern [max]", "Print the addresses where a byte pattern occurs", cmd_find },
+	{ "baud", "divisor", "Set the UART baud rate divisor (UART clock / 16 / divisor)", cmd_baud },
 	{ "imb", "", "Instruction memory barrier", cmd_imb },
 	{ "call", "address [up to 3 args]", "Call a function by address", cmd_call },
 	{ "src", "address", "Source/run script at address", cmd_src },
@@ -2,95 +2,219 @@
 # SPDX-License-Identifier: MIT
 # Copyright (C) J. Neuschäfer
 #
-# Turn LCD commands in trace logs into an animated GIF
-import re, sys
-from PIL import Image, ImageDraw
-
-re_sspi = re.compile('^\[.*\] SSPI.WR[A-Z]* ([01]), .*\[([0-9]*),([0-9]*)\] *([0-9a-f ]*) -> ([0-9a-f ]*)$')
-
-def parse_hex(h):
-    h = h.strip()
-    if h == '':
-        return b''
-    return bytes([int(x, 16) for x in h.strip().split(' ')])
-
-last_row = 0
-matrix = {}
-
-frame_log = []
-interesting_rows = set()
-max_width = 0
-
-def save_frame():
-    if 0 not in matrix:
-        return
-
-    for row in matrix:
-        data = matrix[row]
-        if data != b'\0' * len(data):
-            interesting_rows.add(row)
-            global max_width
-            if len(data) > max_width:
-                max_width = len(data)
-            frame_log.append(matrix.copy())
-
-
-def crunch(fn):
-    f = open(fn, 'r')
-    last_row = 0
-
-    for line in f.readlines():
-        m = re_sspi.match(line)
-        if not m:
-            continue
-
-        cs = int(m.group(1))
-        send_len = int(m.group(2))
-        recv_len = int(m.group(3))
-        send_data = parse_hex(m.group(4))
-        recv_data = parse_hex(m.group(5))
-
-        assert len(send_data) == send_len
-        assert len(recv_data) == recv_len
-
-        if cs == 0 and send_len == 4:
-            assert send_data[0] == 0x46
-            assert send_data[1] in range(0xb0, 0xbf)
-            row = send_data[1] - 0xb0
-            if row < last_row:
-                save_frame()
-            last_row = row
-
-        if cs == 1:
-            matrix[last_row] = send_data
-
-def write_gif(fn):
-    rows = list(interesting_rows)
-    height = len(rows) * 8
-    width = max_width
-
-    frames = []
-    for matrix in frame_log:
-        im = Image.new('RGB', (width, height), "blue")
-        px = im.load()
-
-        for ri, row in enumerate(rows):
-            data = matrix[row]
-            for i in range(len(data)):
-                for j in range(8):
-                    if (1 << j) & data[i]:
-                        px[i, 8*ri+j] = 0xffffff
-
-        frames.append(im)
-
-    if frames == []:
-        print("No image data found!")
+# Turn LCD commands in trace logs into an animation: GIF, APNG, or raw video
+#
+# Frames are encoded as soon as they are decoded, and shown for as long as
+# the trace timestamps say, so memory use doesn't grow with the trace.
+import sys, struct, zlib, argparse
+import numpy as np
+import tracelog, traceindex
+from lcdmodel import LCD
+
+PALETTE = [ 0, 0, 255,  255, 255, 255 ] # blue background, white pixels
+
+lcd = LCD()
+
+# Call frame(time) at every frame boundary; records before start only update
+# the LCD state. Returns the time at which the trace (or the range) ends.
+def crunch(records, frame, start=None, end=None):
+    t = start or 0
+    for record in records:
+        if end is not None and record.time >= end:
+            return end
+        t = record.time
+        if lcd.feed(record) and (start is None or t >= start) and lcd.ready():
+            frame(t)
+    return t
+
+# Palette indices of one page, padded or cut to width
+def render_page(data, width, scale=1):
+    columns = np.zeros((1, width), dtype=np.uint8)
+    d = np.frombuffer(data, dtype=np.uint8)[:width]
+    columns[0, :len(d)] = d
+    pixels = np.unpackbits(columns, axis=0, bitorder='little')
+    return pixels.repeat(scale, axis=0).repeat(scale, axis=1)
+
+
+# Writers get each frame with its duration, in ticks of writer.tick seconds
+
+class GIFWriter:
+    tick = 0.01
+    max_ticks = 0xffff
+
+    def __init__(self, f, width, height):
+        self.f = f
+        self.size = (width, height)
+        self.first = True
+
+    # Pillow is only needed for GIF output
+    def write(self, pixels, ticks):
+        from PIL import Image, GifImagePlugin
+        im = Image.frombytes('P', self.size, pixels.tobytes())
+        im.putpalette(PALETTE)
+        if self.first:
+            header, _ = GifImagePlugin.getheader(im, info={ 'loop': 0 })
+            self.f.write(b''.join(header))
+            self.first = False
+        self.f.write(b''.join(GifImagePlugin.getdata(im, duration=ticks * 10)))
+
+    def close(self):
+        self.f.write(b';')
+
+# The number of frames is only known at the end, so the acTL chunk is
+# patched, and the output must be seekable
+class APNGWriter:
+    tick = 0.001
+    max_ticks = 0xffff
+
+    def __init__(self, f, width, height):
+        self.f = f
+        self.size = (width, height)
+        self.frames = 0
+        self.seq = 0
+        f.write(b'\x89PNG\r\n\x1a\n')
+        self.chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0))
+        self.chunk(b'PLTE', bytes(PALETTE))
+        self.actl = f.tell()
+        self.chunk(b'acTL', struct.pack('>II', 0, 0))
+
+    def chunk(self, kind, data):
+        self.f.write(struct.pack('>I', len(data)) + kind + data)
+        self.f.write(struct.pack('>I', zlib.crc32(kind + data)))
+
+    def write(self, pixels, ticks):
+        self.chunk(b'fcTL', struct.pack('>IIIIIHHBB', self.seq, *self.size, 0, 0, ticks, 1000, 0, 0))
+        self.seq += 1
+
+        # Filter type 0 in front of each line
+        lines = np.insert(pixels, 0, 0, axis=1)
+        data = zlib.compress(lines.tobytes())
+        if self.frames == 0:
+            self.chunk(b'IDAT', data)
+        else:
+            self.chunk(b'fdAT', struct.pack('>I', self.seq) + data)
+            self.seq += 1
+        self.frames += 1
+
+    def close(self):
+        self.chunk(b'IEND', b'')
+        self.f.seek(self.actl)
+        self.chunk(b'acTL', struct.pack('>II', self.frames, 0))
+
+# RGB frames at a constant frame rate, for ffmpeg
+class RawWriter:
+    max_ticks = None
+
+    def __init__(self, f, width, height, fps):
+        self.f = f
+        self.size = (width, height)
+        self.fps = fps
+        self.tick = 1 / fps
+        self.colors = np.array(PALETTE, dtype=np.uint8).reshape(-1, 3)
+
+    def write(self, pixels, ticks):
+        data = self.colors[pixels].tobytes()
+        for i in range(ticks):
+            self.f.write(data)
+
+    def close(self):
+        print('ffmpeg -f rawvideo -pix_fmt rgb24 -s %dx%d -r %g -i lcd.raw lcd.mp4' %
+              (*self.size, self.fps), file=sys.stderr)
+
+
+# Consecutive identical frames (by LCD.frame_hash) are merged, and frames that
+# don't last for a whole tick are dropped. The image of the frame that is
+# currently shown is kept, and only the pages that changed are drawn again.
+class Exporter:
+    def __init__(self, open_writer, rows, width, scale=1):
+        self.open_writer = open_writer
+        self.writer = None
+        self.slots = { row: slot for slot, row in enumerate(sorted(rows)) }
+        self.width = width
+        self.scale = scale
+        self.pixels = np.zeros((len(rows) * 8 * scale, width * scale), dtype=np.uint8)
+        self.pending = None # (frame hash, start tick)
+        self.frames = 0
+        self.decoded = 0
+
+    def frame(self, t):
+        self.decoded += 1
+        if self.writer is None:
+            self.writer = self.open_writer(*reversed(self.pixels.shape))
+            lcd.dirty.update(self.slots)
+        digest = lcd.frame_hash()
+        tick = round(t / self.writer.tick)
+        if self.pending:
+            if self.pending[0] == digest:
+                return
+            if tick > self.pending[1]:
+                self.emit(tick)
+
+        height = 8 * self.scale
+        for row in lcd.dirty & self.slots.keys():
+            slot = self.slots[row]
+            self.pixels[slot * height:(slot + 1) * height] = render_page(lcd.page(row), self.width, self.scale)
+        lcd.dirty.clear()
+        self.pending = (digest, tick)
+
+    def emit(self, tick):
+        start = self.pending[1]
+        ticks = tick - start
+        limit = self.writer.max_ticks or ticks
+        while ticks > 0:
+            self.writer.write(self.pixels, min(ticks, limit))
+            ticks -= limit
+        self.frames += 1
+
+    def close(self, t):
+        if self.pending is None:
+            print("No image data found!", file=sys.stderr)
+            return
+        self.emit(max(round(t / self.writer.tick), self.pending[1] + 1))
+        self.writer.close()
+        print(self.frames, "frames saved,", self.decoded, "decoded.", file=sys.stderr)
+
+
+# Guarded, because parallel parsing may import this file in worker processes
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='turn LCD commands in trace logs into an animation')
+    parser.add_argument('log', help='trace log, - for stdin')
+    parser.add_argument('output', help='lcd.gif, lcd.png (APNG), lcd.raw, or - for stdout')
+    parser.add_argument('--format', choices=['gif', 'apng', 'raw'], help='output format (default: from the file name)')
+    parser.add_argument('--scale', type=int, default=1, help='size of an LCD pixel, in image pixels')
+    parser.add_argument('--fps', type=float, default=25, help='frame rate of raw output')
+    parser.add_argument('-j', '--jobs', type=int, help='parser processes for big logs (default: one per CPU)')
+    parser.add_argument('--from', dest='start', type=float, help='start time: a trace timestamp, in seconds, not an offset from the start of the log; uses the index in trace.log.idx')
+    parser.add_argument('--to', dest='end', type=float, help='end time: a trace timestamp, in seconds')
+    args = parser.parse_args()
+
+    fmt = args.format or { 'png': 'apng', 'apng': 'apng', 'raw': 'raw' }.get(args.output.rsplit('.', 1)[-1], 'gif')
+    if fmt == 'apng' and args.output == '-' and not sys.stdout.buffer.seekable():
+        parser.error('APNG output must be seekable, because its frame count is patched at the end')
+
+    # The image size comes from the index, which knows which rows are used,
+    # and how wide they are. Without an index of stdin, the whole LCD is shown.
+    if args.log == '-':
+        index = None
+        rows, width = range(len(lcd.pages)), len(lcd.pages[0])
+    else:
+        index = traceindex.Index(args.log).update()
+        error = index.range_error(args.start, args.end)
+        if error:
+            parser.error(error)
+        rows, width = index.lcd_geometry(args.start, args.end)
+
+    def open_writer(width, height):
+        f = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+        if fmt == 'raw':
+            return RawWriter(f, width, height, args.fps)
+        return { 'gif': GIFWriter, 'apng': APNGWriter }[fmt](f, width, height)
+
+    if args.start is not None and index:
+        offset, lcd = index.lcd_snapshot(args.start)
+        records = tracelog.sspi_writes(traceindex.read_from(args.log, offset))
     else:
-        frames[0].save(fn, format="GIF", append_images=frames, save_all=True, duration=10, loop=0)
-        print(len(frames), "frames saved.")
-
-if len(sys.argv) == 3:
-    crunch(sys.argv[1])
-    write_gif(sys.argv[2])
-else:
-    print("Usage: lcd.py trace.log lcd.gif")
+        records = tracelog.sspi_writes(args.log, args.jobs)
+
+    exporter = Exporter(open_writer, rows, width, args.scale)
+    exporter.close(crunch(records, exporter.frame, args.start, args.end))
@@ -3,68 +3,129 @@
 # Copyright (C) J. Neuschäfer
 #
 # Analysis of SSPI command logs
-import re, sys
-
-re_sspi = re.compile('^\[.*\] SSPI.WR[A-Z]* ([01]), .*\[([0-9]*),([0-9]*)\] *([0-9a-f ]*) -> ([0-9a-f ]*)$')
-
-def parse_hex(h):
-    h = h.strip()
-    if h == '':
-        return b''
-    return bytes([int(x, 16) for x in h.strip().split(' ')])
-
-last_row = 0
-matrix = {}
+import sys, time, argparse
+import tracelog, traceindex
+from lcdmodel import LCD
+
+lcd = LCD()
+
+def row_lines(data):
+    lines = []
+    for i in range(8):
+        line = ''
+        for byte in data:
+            if byte & (1 << i):
+                line += 'o'
+            else:
+                line += ' '
+        lines.append(line)
+    return lines
 
 def render():
-    if 0 not in matrix:
+    if lcd.widths[0] == 0:
         return
 
-    print(' ' + '-' * len(matrix[0]))
-    for row in matrix:
-        data = matrix[row]
-        if data == b'\0' * len(data):
-            continue
-
-        for i in range(8):
-            line = ''
-            for byte in data:
-                if byte & (1 << i):
-                    line += 'o'
-                else:
-                    line += ' '
+    print(' ' + '-' * lcd.widths[0])
+    for row in lcd.rows():
+        for line in row_lines(lcd.page(row)):
             print(line)
 
 
-
-def crunch(fn):
-    f = open(fn, 'r')
-
-    for line in f.readlines():
-        m = re_sspi.match(line)
-        if not m:
+# Keep the LCD on screen and redraw only the rows that changed, using ANSI
+# cursor control, at most fps times per second
+class Screen:
+    def __init__(self, name, fps=20):
+        self.name = name
+        self.interval = 1 / fps
+        self.rows = []  # non-empty rows, in the order they are shown
+        self.last_draw = 0
+        self.updates = 0
+        self.rate = 0
+        self.rate_start = time.time()
+
+    def update(self):
+        self.updates += 1
+
+    def draw(self, force=False):
+        now = time.time()
+        if not force and now - self.last_draw < self.interval:
+            return
+        self.last_draw = now
+        if now - self.rate_start >= 1:
+            self.rate = self.updates / (now - self.rate_start)
+            self.updates = 0
+            self.rate_start = now
+
+        out = []
+        rows = lcd.rows()
+        if rows != self.rows:
+            out.append('\x1b[2J')
+            self.rows = rows
+            lcd.dirty.update(rows)
+
+        for slot, row in enumerate(rows):
+            if row in lcd.dirty:
+                for i, line in enumerate(row_lines(lcd.page(row))):
+                    out.append('\x1b[%d;1H%s\x1b[K' % (2 + 8 * slot + i, line))
+        lcd.dirty.clear()
+
+        out.append('\x1b[1;1H%s: %.0f updates/s\x1b[K' % (self.name, self.rate))
+        out.append('\x1b[%d;1H' % (2 + 8 * len(rows)))
+        sys.stdout.write(''.join(out))
+        sys.stdout.flush()
+
+
+# Records before start only update the LCD state; end stops the analysis
+def crunch(records, screen=None, start=None, end=None):
+    for record in records:
+        if record is None:
+            screen.draw()
             continue
+        if end is not None and record.time >= end:
+            break
 
-        cs = int(m.group(1))
-        send_len = int(m.group(2))
-        recv_len = int(m.group(3))
-        send_data = parse_hex(m.group(4))
-        recv_data = parse_hex(m.group(5))
-
-        assert len(send_data) == send_len
-        assert len(recv_data) == recv_len
-
-        if cs == 0 and send_len == 4:
-            assert send_data[0] == 0x46
-            assert send_data[1] in range(0xb0, 0xbf)
-            last_row = send_data[1] - 0xb0
-
-        if cs == 1:
-            matrix[last_row] = send_data
+        lcd.feed(record)
+        if record.cs != 1:
+            continue
+        if screen:
+            screen.update()
+            screen.draw()
+        elif lcd.dirty and (start is None or record.time >= start):
+            lcd.dirty.clear()
             render()
 
 
-if len(sys.argv) == 2:
-    crunch(sys.argv[1])
-else:
-    print("Usage: lcd.py trace.log")
+# Guarded, because parallel parsing may import this file in worker processes
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='show the LCD contents from SSPI command logs')
+    parser.add_argument('log', nargs='?', help='trace log, - for stdin (default with --follow: the newest /tmp/trace*.log, from its end)')
+    parser.add_argument('-f', '--follow', action='store_true', help='follow the log as it is written, and show the LCD live')
+    parser.add_argument('-j', '--jobs', type=int, help='parser processes for big logs (default: one per CPU)')
+    parser.add_argument('--fps', type=float, default=20, help='maximum screen updates per second, with --follow')
+    parser.add_argument('--from', dest='start', type=float, help='start time: a trace timestamp, in seconds, not an offset from the start of the log; uses the index in trace.log.idx')
+    parser.add_argument('--to', dest='end', type=float, help='end time: a trace timestamp, in seconds')
+    args = parser.parse_args()
+
+    if args.follow:
+        lines = sys.stdin.buffer if args.log == '-' else tracelog.follow(args.log)
+        screen = Screen(args.log or 'newest /tmp/trace*.log', args.fps)
+        try:
+            crunch(tracelog.sspi_writes(lines), screen)
+        except KeyboardInterrupt:
+            pass
+        screen.draw(force=True)
+    elif args.log:
+        index = None
+        if args.log != '-' and (args.start is not None or args.end is not None):
+            index = traceindex.Index(args.log).update()
+            error = index.range_error(args.start, args.end)
+            if error:
+                parser.error(error)
+        if index and args.start is not None:
+            offset, lcd = index.lcd_snapshot(args.start)
+            lines = traceindex.read_from(args.log, offset)
+            crunch(tracelog.sspi_writes(lines), start=args.start, end=args.end)
+        else:
+            crunch(tracelog.sspi_writes(args.log, args.jobs), start=args.start, end=args.end)
+    else:
+        parser.print_usage()
@@ -0,0 +1,90 @@
+# SPDX-License-Identifier: MIT
+# Copyright (C) J. Neuschäfer
+#
+# Model of the front-panel LCD, as seen in SSPI command logs
+#
+# The LCD controller gets a page select command on chip select 0 (46 bX 00 00,
+# for page X), followed by the column bytes of the page on chip select 1.
+# Each column byte holds eight vertical pixels, least significant bit on top.
+# A frame ends when a page above the current one is selected.
+import hashlib
+
+PAGES = 16  # 0xb0 to 0xbf
+WIDTH = 128
+
+class LCD:
+    def __init__(self, pages=PAGES, width=WIDTH):
+        self.pages = [bytearray(width) for i in range(pages)]
+        self.widths = [0] * pages       # bytes last written to each page
+        self.digests = [None] * pages   # per page, computed when needed
+        self.nonzero = set()            # pages that show something
+        self.dirty = set()              # pages changed since the user last cleared this
+        self.row = 0
+        self.frames = 0
+
+    # Feed one SSPI write; returns True if it ended a frame
+    def feed(self, record):
+        if record.cs == 0 and len(record.send) == 4:
+            assert record.send[0] == 0x46
+            assert record.send[1] in range(0xb0, 0xb0 + len(self.pages))
+            return self.select(record.send[1] - 0xb0)
+        if record.cs == 1:
+            self.write(record.send)
+        return False
+
+    def select(self, row):
+        end = row < self.row
+        self.row = row
+        if end:
+            self.frames += 1
+        return end
+
+    # Returns True if the page changed
+    def write(self, data):
+        row, n = self.row, len(data)
+        page = self.pages[row]
+        if n > len(page):
+            page.extend(bytes(n - len(page)))
+        if self.widths[row] == n and memoryview(page)[:n] == data:
+            return False
+
+        page[:n] = data
+        self.widths[row] = n
+        self.digests[row] = None
+        self.dirty.add(row)
+        if data.count(0) == n:
+            self.nonzero.discard(row)
+        else:
+            self.nonzero.add(row)
+        return True
+
+    def page(self, row):
+        return memoryview(self.pages[row])[:self.widths[row]]
+
+    # Pages that show something, top to bottom
+    def rows(self):
+        return sorted(self.nonzero)
+
+    # The first page was written, and something is shown
+    def ready(self):
+        return self.widths[0] != 0 and len(self.nonzero) != 0
+
+    def width(self):
+        return max((self.widths[row] for row in self.nonzero), default=0)
+
+    # Content hash of the whole display; only changed pages are hashed again
+    def frame_hash(self):
+        for row, digest in enumerate(self.digests):
+            if digest is None:
+                self.digests[row] = hashlib.blake2b(self.page(row), digest_size=8).digest()
+        return hashlib.blake2b(b''.join(self.digests), digest_size=16).digest()
+
+    # For trace indexes: (current row, { row: hex data })
+    def state(self):
+        return self.row, { str(row): self.page(row).hex() for row in range(len(self.pages)) if self.widths[row] }
+
+    def load(self, row, pages):
+        for r, data in pages.items():
+            self.row = int(r)
+            self.write(bytes.fromhex(data) if isinstance(data, str) else data)
+        self.row = row
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# Copyright (C) J. Neuschäfer
+#
+# Sidecar seek index for trace.so logs
+#
+# The index of trace.log is kept in trace.log.idx, as JSON. It has the byte
+# offset of the first record in every INTERVAL seconds, overall and for each
+# record kind, and a snapshot of the LCD state every SNAPSHOT_INTERVAL
+# seconds, so that the tools can start in the middle of a log. For each
+# snapshot, it also has the pages that were shown in the following frames, and
+# their width, so lcd-gif.py knows the image size without decoding the log
+# twice. When the log has grown, only the new part is scanned.
+import os, sys, json, bisect
+import tracelog
+from lcdmodel import LCD
+
+VERSION = 4
+INTERVAL = 1.0
+SNAPSHOT_INTERVAL = 60.0
+
+class Index:
+    def __init__(self, fn):
+        self.fn = fn
+        self.path = fn + '.idx'
+        self.reset()
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                saved = json.load(f)
+            if saved.get('version') == VERSION:
+                self.__dict__.update(saved['index'])
+                self.lcd.load(*self.__dict__.pop('lcd_state'))
+
+    def reset(self):
+        self.size = 0
+        self.last = None    # time of the last record
+        self.times = []     # [time, offset]
+        self.kinds = {}     # kind: [[time, offset]]
+        self.snapshots = [] # [time, offset, row, { row: hex data }], see LCD.state
+        self.geometry = []  # [row bitmap, width] of the frames after each snapshot
+
+        # Scanner state, to continue where the last update stopped
+        self.slot = None
+        self.kind_slots = {}
+        self.next_snapshot = 0
+        self.lcd = LCD()
+
+    def save(self):
+        index = { k: v for k, v in self.__dict__.items() if k not in ['fn', 'path', 'lcd'] }
+        index['lcd_state'] = self.lcd.state()
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({ 'version': VERSION, 'index': index }, f)
+        os.replace(self.path + '.tmp', self.path)
+
+    # Scan the part of the log that was added since the last update. An
+    # incomplete last line is left for the next update.
+    def update(self):
+        if os.path.getsize(self.fn) < self.size:
+            self.reset() # the log was replaced
+        offset = self.size
+
+        with open(self.fn, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                m = tracelog.re_record.match(line)
+                if m:
+                    self.add(line, m, offset)
+                offset += len(line)
+
+        if offset != self.size:
+            self.size = offset
+            self.save()
+        return self
+
+    def add(self, line, m, offset):
+        t = int(m.group(1)) + int(m.group(2)) / 1000
+        k = tracelog.re_kind.match(m.group(3))
+        kind = k.group(1).decode('ascii') if k else 'TEXT'
+        self.last = t
+
+        slot = int(t // INTERVAL)
+        if slot != self.slot:
+            self.times.append([t, offset])
+            self.slot = slot
+        if self.kind_slots.get(kind) != slot:
+            self.kinds.setdefault(kind, []).append([t, offset])
+            self.kind_slots[kind] = slot
+
+        # The snapshot describes the state before this line
+        if t >= self.next_snapshot:
+            self.snapshots.append([t, offset, *self.lcd.state()])
+            self.geometry.append([0, 0])
+            self.next_snapshot = (t // SNAPSHOT_INTERVAL + 1) * SNAPSHOT_INTERVAL
+
+        if kind == 'SSPI.WR':
+            record = tracelog.parse_sspi(line)
+            if record and self.lcd.feed(record) and self.lcd.ready():
+                geometry = self.geometry[-1]
+                geometry[0] |= sum(1 << row for row in self.lcd.nonzero)
+                geometry[1] = max(geometry[1], self.lcd.width())
+
+    # Offset from which to read, to see everything (of a kind) from time t on
+    def seek(self, t, kind=None):
+        entries = self.kinds.get(kind, []) if kind else self.times
+        i = bisect.bisect_right([e[0] for e in entries], t)
+        if i == 0:
+            return entries[0][1] if entries else self.size
+        return entries[i - 1][1]
+
+    # Times are trace timestamps, not offsets from the start of the log. For
+    # --from/--to: an error message if no part of start to end is in the log
+    def range_error(self, start=None, end=None):
+        if not self.times:
+            return f'{self.fn} has no trace records'
+        first = self.times[0][0]
+        if (start is not None and start > self.last) or (end is not None and end <= first) or \
+           (start is not None and end is not None and start >= end):
+            asked = ' '.join(f'{flag} {t:g}' for flag, t in [('--from', start), ('--to', end)] if t is not None)
+            return f'nothing to show for {asked}: {self.fn} has timestamps from {first:.3f} to {self.last:.3f} s'
+        return None
+
+    # LCD state at some point before time t: (offset, LCD)
+    def lcd_snapshot(self, t):
+        lcd = LCD()
+        i = bisect.bisect_right([s[0] for s in self.snapshots], t)
+        if i == 0:
+            return 0, lcd
+        t, offset, row, pages = self.snapshots[i - 1]
+        lcd.load(row, pages)
+        return offset, lcd
+
+    # Pages shown in the frames from start to end, and their width, at the
+    # granularity of snapshots: (rows, width)
+    def lcd_geometry(self, start=None, end=None):
+        bitmap, width = 0, 0
+        for i, (t, offset, row, pages) in enumerate(self.snapshots):
+            if end is not None and t >= end:
+                break
+            if start is not None and i + 1 < len(self.snapshots) and self.snapshots[i + 1][0] <= start:
+                continue
+            bitmap |= self.geometry[i][0]
+            width = max(width, self.geometry[i][1])
+        return [row for row in range(bitmap.bit_length()) if bitmap >> row & 1], width
+
+
+# Lines of a log, from a byte offset on
+def read_from(fn, offset):
+    with open(fn, 'rb') as f:
+        f.seek(offset)
+        yield from f
+
+def summary(index):
+    if index.times:
+        print('%s: %d bytes, %.3f to %.3f s, %d LCD snapshots' % (index.fn, index.size,
+              index.times[0][0], index.last, len(index.snapshots)))
+    for kind, entries in sorted(index.kinds.items()):
+        print('  %-10s from %10.3f s' % (kind, entries[0][0]))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 2:
+        summary(Index(sys.argv[1]).update())
+    else:
+        print("Usage: traceindex.py trace.log  (creates or updates trace.log.idx)")
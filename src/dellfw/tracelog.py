@@ -0,0 +1,269 @@
+# SPDX-License-Identifier: MIT
+# Copyright (C) J. Neuschäfer
+#
+# Streaming parser for trace.so logs
+#
+# Logs are read line by line in binary mode, so that multi-gigabyte traces
+# can be processed in constant memory. Lines are pre-filtered with a plain
+# substring test, and only the survivors go through the regex.
+import re, sys, os, glob, time, itertools
+import multiprocessing
+from collections import namedtuple, deque
+
+# One SSPI.WR ioctl: timestamp in seconds, chip select, fields reported by
+# the driver, and the data sent and received
+SSPIWrite = namedtuple('SSPIWrite', 'time cs proc_time mode speed send recv')
+
+re_sspi = re.compile(rb'^\[ *([0-9]+)\.([0-9]+)\] SSPI\.WR[A-Z]* ([01]), '
+                     rb'time *([0-9]+), mode ([0-9a-f]+), speed *([0-9]+), '
+                     rb'\[([0-9]*),([0-9]*)\] *([0-9a-f ]*) -> ([0-9a-f ]*)$')
+
+def parse_hex(h):
+    return bytes.fromhex(h.decode('ascii'))
+
+# Open a trace log by name; '-' means stdin
+def open_log(fn):
+    if fn == '-':
+        return sys.stdin.buffer
+    return open(fn, 'rb')
+
+def parse_sspi(line):
+    m = re_sspi.match(line.rstrip(b'\r\n'))
+    if not m:
+        return None
+
+    send = parse_hex(m.group(9))
+    recv = parse_hex(m.group(10))
+    assert len(send) == int(m.group(7))
+    assert len(recv) == int(m.group(8))
+
+    return SSPIWrite(int(m.group(1)) + int(m.group(2)) / 1000, int(m.group(3)),
+                     int(m.group(4)), int(m.group(5), 16), int(m.group(6)), send, recv)
+
+# Any record: kind (e.g. 'MEM.RD'), channel (chip select, port, ID, etc.),
+# up to three integer fields as named in FIELDS[kind], and the data buffers.
+# Lines that don't fit a known format become TEXT records, with the text
+# (or, for unknown kinds, everything after the kind) as data.
+Record = namedtuple('Record', 'time kind channel fields data data2')
+
+# Formats of the records that trace.c writes, after the kind. Groups named
+# x_* are hex numbers; count groups are only used to check the data length.
+SPECS = {
+    'MEM.REQ':   rb'(?P<channel>\d+) (?P<x_addr>[0-9a-f]+):(?P<x_size>[0-9a-f]+)',
+    'MEM.REL':   rb'(?P<channel>\d+) (?P<x_addr>[0-9a-f]+):(?P<x_size>[0-9a-f]+)',
+    'MEM.RD':    rb'(?P<channel>\d+) (?P<x_addr>[0-9a-f]+) -> \[ *(?P<words>\d+)\](?P<data>[0-9a-f ]*)',
+    'MEM.WR':    rb'(?P<channel>\d+) (?P<x_addr>[0-9a-f]+) <- \[ *(?P<words>\d+)\](?P<data>[0-9a-f ]*)',
+    'IRQ.INIT':  rb'dynairq +(?P<channel>\d+) (?P<x_flags>[0-9a-f]+) (?P<x_param>[0-9a-f]+) \S+',
+    'IRQ.CFG':   rb'dynairq +(?P<channel>\d+) (?P<x_flags>[0-9a-f]+) (?P<x_param>[0-9a-f]+) \S+',
+    'IRQ.CLR':   rb'dynairq +(?P<channel>\d+)',
+    'IRQ.UM':    rb'irq (?P<channel>\d+) (?P<event>\d+)',
+    'GPIO.RD':   rb'(?P<channel>\d+) +(?P<pin>\d+) -> (?P<value>\d+)',
+    'GPIO.WR':   rb'(?P<channel>\d+) +(?P<pin>\d+) <- (?P<value>\d+)',
+    'I2C.INIT':  rb'(?P<channel>\d+) \.\.\.',
+    'I2C.WR':    rb'(?P<channel>\d+) \.\.\.',
+    'I2C.HW':    rb'(?P<channel>\d+) \.\.\.',
+    'PWM.INIT':  rb'(?P<channel>\d+) <- duty (?P<duty>\d+), freq (?P<freq>\d+), div (?P<div>\d+)',
+    'PWM.SET':   rb'(?P<channel>\d+) <- duty (?P<duty>\d+), freq (?P<freq>\d+), div (?P<div>\d+)',
+    'PWM.INFO':  rb'(?P<channel>\d+) -> duty (?P<duty>\d+), freq (?P<freq>\d+), div (?P<div>\d+)',
+    'PWM.DBG':   rb'(?P<channel>\d+) <- duty (?P<duty>\d+), freq (?P<freq>\d+), div (?P<div>\d+)',
+    'POST.INIT': rb'(?P<channel>\d+) (?P<x_port>[0-9a-f]{4})',
+    'POST.RD':   rb'(?P<channel>\d+) (?P<x_port>[0-9a-f]{4}) \[(?P<count>\d+)\](?P<data>[0-9a-f ]*)',
+    'POST.RST':  rb'(?P<channel>\d+)',
+    'KCS.RD':    rb'(?P<channel>\d+) \[(?P<count>\d+)\](?P<data>[0-9a-f ]*)',
+    'KCS.WR':    rb'(?P<channel>\d+) \[(?P<count>\d+)\](?P<data>[0-9a-f ]*)',
+    'SSPI.WR':   rb'(?P<channel>[01]), time *(?P<time>\d+), mode (?P<x_mode>[0-9a-f]+), speed *(?P<speed>\d+), '
+                 rb'\[(?P<count>\d+),(?P<count2>\d+)\] *(?P<data>[0-9a-f ]*) -> (?P<data2>[0-9a-f ]*)',
+    'ADC.RD':    rb'(?P<channel>\d+) -> *(?P<reading>-?\d+)',
+    'FAN.CFG':   rb'(?P<channel>\d+) <- (?P<ppr>\d+) ppr',
+    'FAN.RD':    rb'(?P<channel>\d+) -> (?P<rpm>\d+) rpm',
+    'PECI.RD':   rb'(?P<x_channel>[0-9a-f]+) -> (?P<x_reading>[0-9a-f]+)',
+    'PECI.QRY':  rb'(?P<x_channel>[0-9a-f]+)',
+    'PECI.CMD':  rb'(?P<x_channel>[0-9a-f]+):(?P<x_command>[0-9a-f]+) \[(?P<count>\d+),(?P<count2>\d+)\]'
+                 rb'(?P<data>[0-9a-f ]*) -> (?P<data2>[0-9a-f ]*)',
+    'EV.GET':    rb'driver (?P<channel>\d+), event (?P<event>\d+)',
+}
+
+re_specs = { kind.encode(): re.compile(b' *' + spec + b' *$') for kind, spec in SPECS.items() }
+FIELDS = { kind: tuple(name[2:] if name.startswith('x_') else name
+                       for name in re_specs[kind.encode()].groupindex
+                       if name not in ['channel', 'x_channel', 'data', 'data2', 'count', 'count2'])
+           for kind in SPECS }
+FIELDS['TEXT'] = ()
+
+re_record = re.compile(rb'^\[ *([0-9]+)\.([0-9]+)\] +(.*)$')
+re_kind = re.compile(rb'([A-Z0-9]+\.[A-Za-z0-9]+)')
+
+# Decode a hex dump; MEM records dump 16- and 32-bit words, which are stored
+# in little-endian order
+def parse_words(h):
+    words = h.split()
+    if not words or len(words[0]) == 2:
+        return bytes.fromhex(h.decode('ascii'))
+    width = len(words[0]) // 2
+    return b''.join(int(w, 16).to_bytes(width, 'little') for w in words)
+
+def parse_record(line):
+    line = line.rstrip(b'\r\n')
+    m = re_record.match(line)
+    if not m:
+        return Record(float('nan'), 'TEXT', 0, (), line, b'')
+
+    time = int(m.group(1)) + int(m.group(2)) / 1000
+    body = m.group(3)
+    k = re_kind.match(body)
+    spec = re_specs.get(k.group(1)) if k else None
+    f = spec.match(body, k.end()) if spec else None
+    if f:
+        groups = f.groupdict()
+        for count, data in [('count', 'data'), ('count2', 'data2'), ('words', 'data')]:
+            if count in groups and int(groups[count]) != len(groups[data].split()):
+                f = None
+    if not f:
+        return Record(time, 'TEXT', 0, (), body, b'')
+
+    channel = groups.get('channel') or groups.get('x_channel')
+    channel = int(channel, 16 if 'x_channel' in groups else 10)
+    fields = tuple(int(groups[name], 16 if name.startswith('x_') else 10)
+                   for name in f.re.groupindex
+                   if name not in ['channel', 'x_channel', 'data', 'data2', 'count', 'count2'])
+    data = parse_words(groups['data']) if groups.get('data') else b''
+    data2 = parse_words(groups['data2']) if groups.get('data2') else b''
+    return Record(time, k.group(1).decode('ascii'), channel, fields, data, data2)
+
+# Yield all records in a log file (or an iterable of lines)
+def records(f, jobs=None):
+    if isinstance(f, str) and use_parallel(f, jobs):
+        yield from parallel(f, 'records', jobs)
+        return
+    if isinstance(f, str):
+        f = open_log(f)
+    for line in f:
+        yield parse_record(line)
+
+
+# Parallel parsing: a log file is split into byte ranges that start and end
+# at line boundaries, and the ranges are parsed in a process pool. Results
+# come back in file order, which is also timestamp order, because trace.so
+# appends to the log. Decoding that depends on earlier records (like the
+# LCD's selected row) happens in the caller, on the merged stream, so it is
+# not affected by where the ranges are cut.
+PARALLEL_CHUNK = 16 << 20 # bytes per range
+IN_FLIGHT = 2             # ranges submitted per job, ahead of the consumer
+
+def use_parallel(fn, jobs):
+    jobs = jobs or os.cpu_count() or 1
+    return fn != '-' and jobs > 1 and os.path.getsize(fn) > PARALLEL_CHUNK
+
+def line_ranges(fn, size=None):
+    size = size or PARALLEL_CHUNK
+    ranges = []
+    with open(fn, 'rb') as f:
+        total = os.fstat(f.fileno()).st_size
+        start = 0
+        while start < total:
+            f.seek(min(start + size, total))
+            f.readline()
+            end = min(f.tell(), total)
+            ranges.append((fn, start, end))
+            start = end
+    return ranges
+
+# Worker: parse one range, either all records or only SSPI writes
+def parse_range(args):
+    fn, start, end, what = args
+    with open(fn, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    if what == 'records':
+        return [parse_record(line) for line in data.split(b'\n') if line]
+
+    result = []
+    pos = data.find(b'SSPI.WR')
+    while pos >= 0:
+        line_start = data.rfind(b'\n', 0, pos) + 1
+        line_end = data.find(b'\n', pos)
+        if line_end < 0:
+            line_end = len(data)
+        record = parse_sspi(data[line_start:line_end])
+        if record:
+            result.append(record)
+        pos = data.find(b'SSPI.WR', line_end)
+    return result
+
+# Only a few ranges are parsed ahead of the consumer, so that a slow consumer
+# doesn't make parsed results pile up in memory
+def parallel(fn, what, jobs=None):
+    jobs = jobs or os.cpu_count() or 1
+    ranges = iter([r + (what,) for r in line_ranges(fn)])
+    pending = deque()
+    with multiprocessing.Pool(jobs) as pool:
+        for r in itertools.islice(ranges, IN_FLIGHT * jobs):
+            pending.append(pool.apply_async(parse_range, (r,)))
+        while pending:
+            result = pending.popleft().get()
+            r = next(ranges, None)
+            if r:
+                pending.append(pool.apply_async(parse_range, (r,)))
+            yield from result
+
+def newest_log(pattern='/tmp/trace*.log'):
+    logs = glob.glob(pattern)
+    return max(logs, key=os.path.getmtime) if logs else None
+
+# Yield the lines of a log as it is being written, like tail -f, and None
+# whenever there is nothing new, so that the consumer can do periodic work.
+# A log given as fn is read from the start. Without fn, the newest log
+# matching pattern is followed from its current end (or from the start, if
+# it only appears later), and a newer one is picked up when it appears
+# (e.g. when fullfw is restarted). While no log matches, this keeps polling.
+def follow(fn=None, pattern='/tmp/trace*.log', poll=0.05):
+    current = fn or newest_log(pattern)
+    at_end = current is not None
+    while current is None:
+        yield None
+        time.sleep(poll)
+        current = newest_log(pattern)
+
+    f = open_log(current)
+    if not fn and at_end:
+        f.seek(0, os.SEEK_END)
+    partial = b''
+    while True:
+        line = f.readline()
+        if line.endswith(b'\n'):
+            yield partial + line
+            partial = b''
+            continue
+        partial += line
+
+        if not fn:
+            newest = newest_log(pattern)
+            if newest is not None and newest != current:
+                f.close()
+                current = newest
+                f = open_log(current)
+                partial = b''
+                continue
+
+        yield None
+        time.sleep(poll)
+
+# Yield the SSPI writes in a log file (or an iterable of lines). None
+# items, as produced by follow(), are passed through. Big files are parsed
+# with jobs processes (default: one per CPU).
+def sspi_writes(f, jobs=None):
+    if isinstance(f, str) and use_parallel(f, jobs):
+        yield from parallel(f, 'sspi', jobs)
+        return
+    if isinstance(f, str):
+        f = open_log(f)
+    for line in f:
+        if line is None:
+            yield None
+            continue
+        if b'SSPI.WR' not in line:
+            continue
+        record = parse_sspi(line)
+        if record:
+            yield record
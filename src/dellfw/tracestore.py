@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# Copyright (C) J. Neuschäfer
+#
+# Columnar store for trace.so logs
+#
+# A log is parsed once (see tracelog.py) into a directory with three files:
+#
+#   records.bin   fixed-size records, see DTYPE
+#   payload.bin   the data buffers of all records, back to back
+#   meta.json     the record kinds, and the field names of each kind
+#
+# Both binary files are memory-mapped when the store is opened, so repeated
+# analysis of big traces doesn't need to parse any text.
+import os, json, argparse
+import numpy as np
+import tracelog
+
+DTYPE = np.dtype([
+    ('time',    '<f8'),      # seconds, as logged (modulo 1000000)
+    ('kind',    'u1'),       # index into TraceStore.kinds
+    ('channel', '<i4'),
+    ('fields',  '<u4', (3,)),# named in tracelog.FIELDS; 32-bit two's complement
+    ('offset',  '<u8'),      # data and data2, in payload.bin
+    ('length',  '<u4'),
+    ('length2', '<u4'),
+])
+
+CHUNK = 0x10000 # records buffered during conversion
+
+def convert(log, path, jobs=None):
+    os.makedirs(path, exist_ok=True)
+    kinds = ['TEXT'] + list(tracelog.SPECS)
+    kind_index = { kind: i for i, kind in enumerate(kinds) }
+    count = offset = 0
+
+    with open(os.path.join(path, 'records.bin'), 'wb') as rf, \
+         open(os.path.join(path, 'payload.bin'), 'wb') as pf:
+        rows, payload = [], []
+        for record in tracelog.records(log, jobs):
+            fields = tuple(x & 0xffffffff for x in record.fields) + (0,) * (3 - len(record.fields))
+            rows.append((record.time, kind_index[record.kind], record.channel, fields,
+                         offset, len(record.data), len(record.data2)))
+            if record.data or record.data2:
+                payload += [record.data, record.data2]
+                offset += len(record.data) + len(record.data2)
+            if len(rows) == CHUNK:
+                np.array(rows, dtype=DTYPE).tofile(rf)
+                pf.write(b''.join(payload))
+                count += len(rows)
+                rows, payload = [], []
+        np.array(rows, dtype=DTYPE).tofile(rf)
+        pf.write(b''.join(payload))
+        count += len(rows)
+
+    meta = { 'version': 1, 'records': count, 'kinds': kinds,
+             'fields': { kind: tracelog.FIELDS[kind] for kind in kinds } }
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+    return count
+
+
+class TraceStore:
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.kinds = meta['kinds']
+        self.fields = meta['fields']
+        self.records = self.map(os.path.join(path, 'records.bin'), DTYPE)
+        self.payload = self.map(os.path.join(path, 'payload.bin'), np.uint8)
+
+    @staticmethod
+    def map(fn, dtype):
+        if os.path.getsize(fn) == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(fn, dtype=dtype, mode='r')
+
+    # Select records by kind (a name like 'MEM.RD', a family like 'MEM', or
+    # a list of these), channel, and time range [start, end)
+    def query(self, kind=None, channel=None, start=None, end=None):
+        r = self.records
+        mask = np.ones(len(r), dtype=bool)
+        if kind is not None:
+            names = [kind] if isinstance(kind, str) else kind
+            wanted = [i for i, k in enumerate(self.kinds)
+                      if k in names or k.split('.')[0] in names]
+            mask &= np.isin(r['kind'], wanted)
+        if channel is not None:
+            mask &= r['channel'] == channel
+        if start is not None:
+            mask &= r['time'] >= start
+        if end is not None:
+            mask &= r['time'] < end
+        return r[mask]
+
+    def kind(self, record):
+        return self.kinds[record['kind']]
+
+    def data(self, record):
+        start = int(record['offset'])
+        return bytes(self.payload[start:start + record['length']])
+
+    def data2(self, record):
+        start = int(record['offset'] + record['length'])
+        return bytes(self.payload[start:start + record['length2']])
+
+    def named_fields(self, record):
+        names = self.fields[self.kind(record)]
+        return dict(zip(names, (int(x) for x in record['fields'])))
+
+    def format(self, record):
+        kind = self.kind(record)
+        line = '[%10.3f] %-9s %3d' % (record['time'], kind, record['channel'])
+        for name, value in self.named_fields(record).items():
+            line += ' %s=%#x' % (name, value)
+        if record['length']:
+            line += ' ' + (self.data(record).decode('UTF-8', 'replace') if kind == 'TEXT'
+                           else self.data(record).hex(' '))
+        if record['length2']:
+            line += ' -> ' + self.data2(record).hex(' ')
+        return line
+
+    def stats(self):
+        counts = np.bincount(self.records['kind'], minlength=len(self.kinds))
+        for kind, count in zip(self.kinds, counts):
+            if count:
+                print('%-10s %10d' % (kind, count))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='convert trace.so logs into a columnar store, and query it')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('convert', help='parse a log (- for stdin) into a store')
+    p.add_argument('log')
+    p.add_argument('store')
+    p.add_argument('-j', '--jobs', type=int, help='parser processes (default: one per CPU)')
+    p = sub.add_parser('stats', help='count the records of each kind')
+    p.add_argument('store')
+    p = sub.add_parser('query', help='print selected records')
+    p.add_argument('store')
+    p.add_argument('-k', '--kind', action='append', help='record kind, e.g. MEM.RD or MEM')
+    p.add_argument('-c', '--channel', type=int)
+    p.add_argument('--from', dest='start', type=float, help='start time, in seconds')
+    p.add_argument('--to', dest='end', type=float, help='end time, in seconds')
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        print(convert(args.log, args.store, args.jobs), 'records converted.')
+    elif args.command == 'stats':
+        TraceStore(args.store).stats()
+    else:
+        store = TraceStore(args.store)
+        for record in store.query(args.kind, args.channel, args.start, args.end):
+            print(store.format(record))
@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+# SPDX-License-Identifier: MIT
+# Copyright (C) J. Neuschäfer
+#
+# Compose a SPI flash image from components at given offsets. A layout file
+# lists one component per line, for example:
+#
+#   # offset   file
+#   0x000000   lolmon.bin
+#   0x100000   uImage
+#   0x400000   wpcm450.dtb
+#   0x410000   rootfs.squashfs
+#   0xff0000   @aten
+#
+# @aten is the page with the ATEN symbol in it (see gen-aten-symbol.py). Gaps
+# are filled with 0xff, as on an erased flash. Next to the image, a manifest
+# with the SHA-256 hash of every 4 KiB sector is written. interact.py can
+# load it (FlashImage.load_manifest) and then skip sectors that are already
+# up to date, without reading them back.
+import argparse, hashlib, json, os, sys, importlib.util
+
+SECTOR_SIZE = 0x1000
+CHUNK = 0x10000
+ERASED = b'\xff' * CHUNK
+
+# gen-aten-symbol.py isn't a valid module name, so it is loaded by path
+aten_spec = importlib.util.spec_from_file_location('gen_aten_symbol',
+             os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gen-aten-symbol.py'))
+gen_aten_symbol = importlib.util.module_from_spec(aten_spec)
+aten_spec.loader.exec_module(gen_aten_symbol)
+
+class Component:
+    def __init__(self, offset, source):
+        self.offset = offset
+        self.source = source
+        if source == '@aten':
+            self.size = gen_aten_symbol.PAGE_SIZE
+        else:
+            self.size = os.path.getsize(source)
+
+    def chunks(self):
+        if self.source == '@aten':
+            yield gen_aten_symbol.aten_page()
+            return
+        with open(self.source, 'rb') as f:
+            yield from iter(lambda: f.read(CHUNK), b'')
+
+# Writes the image and hashes it, sector by sector, on the way
+class ImageWriter:
+    def __init__(self, f):
+        self.f = f
+        self.pos = 0
+        self.sector = bytearray()
+        self.hashes = []
+
+    def write(self, data):
+        self.f.write(data)
+        self.pos += len(data)
+        self.sector += data
+        full = len(self.sector) - len(self.sector) % SECTOR_SIZE
+        for p in range(0, full, SECTOR_SIZE):
+            self.hashes.append(hashlib.sha256(self.sector[p:p+SECTOR_SIZE]).hexdigest())
+        del self.sector[:full]
+
+    def pad(self, end):
+        while self.pos < end:
+            self.write(ERASED[:min(CHUNK, end - self.pos)])
+
+def parse_layout(fn):
+    components = []
+    with open(fn) as f:
+        for line in f:
+            fields = line.split('#')[0].split()
+            if not fields:
+                continue
+            if len(fields) != 2:
+                sys.exit(f'{fn}: bad line: {line.strip()}')
+            source = fields[1]
+            if source != '@aten' and not os.path.isabs(source):
+                source = os.path.join(os.path.dirname(fn), source)
+            components.append(Component(int(fields[0], 0), source))
+    return components
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compose a flash image from components at given offsets')
+    parser.add_argument('filename')
+    parser.add_argument('-l', '--layout', help='layout file, with "offset file" lines')
+    parser.add_argument('-c', '--component', action='append', default=[], metavar='OFFSET:FILE',
+                        help='add a component (@aten for the ATEN symbol page)')
+    parser.add_argument('--size', type=lambda x: int(x, 0), default=16 << 20, help='flash size (default: 16 MiB)')
+    parser.add_argument('--manifest', help='sector hash manifest (default: filename.manifest)')
+    args = parser.parse_args()
+
+    components = parse_layout(args.layout) if args.layout else []
+    for spec in args.component:
+        offset, source = spec.split(':', 1)
+        components.append(Component(int(offset, 0), source))
+    components.sort(key=lambda c: c.offset)
+
+    if args.size % SECTOR_SIZE:
+        sys.exit('The flash size must be a multiple of 4 KiB')
+    end = 0
+    for c in components:
+        if c.offset < end:
+            sys.exit(f'{c.source} at {c.offset:#08x} overlaps the previous component')
+        end = c.offset + c.size
+        if end > args.size:
+            sys.exit(f'{c.source} at {c.offset:#08x} ends beyond the flash size')
+
+    with open(args.filename, 'wb') as f:
+        image = ImageWriter(f)
+        for c in components:
+            image.pad(c.offset)
+            for chunk in c.chunks():
+                image.write(chunk)
+            print(f'{c.offset:06x}-{c.offset + c.size:06x}  {c.source}')
+        image.pad(args.size)
+
+    manifest = {
+        'version': 1,
+        'size': args.size,
+        'sector_size': SECTOR_SIZE,
+        'hash': 'sha256',
+        'components': [{ 'offset': c.offset, 'size': c.size, 'source': c.source } for c in components],
+        'sectors': image.hashes,
+    }
+    with open(args.manifest or args.filename + '.manifest', 'w') as f:
+        json.dump(manifest, f, indent=1)
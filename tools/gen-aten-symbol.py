@@ -3,20 +3,20 @@
 # Copyright (C) J. Neuschäfer
 import argparse
 
-parser = argparse.ArgumentParser(description='generate a flash page with the ATEN symbol in it')
-parser.add_argument('filename')
+PAGE_SIZE = 0x10000
 
-args = parser.parse_args()
+# Also used by compose-flash.py
+def aten_page():
+    buf = bytearray(b'\xff' * PAGE_SIZE)
+    buf[0xffb3:0xffb3+8] = b'ATENs_FW'
+    return bytes(buf)
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='generate a flash page with the ATEN symbol in it')
+    parser.add_argument('filename')
 
-buf = bytearray(0x10000)
+    args = parser.parse_args()
 
-for i in range(0x10000):
-    buf[i] = 0xff
-
-buf[0xffb3:0xffb3+8] = b'ATENs_FW'
-
-
-f = open(args.filename, 'wb')
-f.write(buf)
-f.close()
+    f = open(args.filename, 'wb')
+    f.write(aten_page())
+    f.close()